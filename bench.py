@@ -0,0 +1,402 @@
+"""离线回放与性能基准测试
+
+不需要 Telegram 账号：用进程内的假客户端代替 TelegramClient 和 Bot，
+将合成的查询结果（剩余可用/剩余时间/订阅链接 格式）回放给 bot.handler，
+统计解析、去重、转发、配置生成各阶段的吞吐量和 p50/p99 延迟，
+并与 bench_baseline.json 中保存的基线比较，出现性能回退或有消息未送达时返回非零退出码。
+
+用法：
+    python bench.py                     # 运行并与基线比较
+    python bench.py --quick             # 缩小规模，快速检查
+    python bench.py --update-baseline   # 运行并更新基线
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import types
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(BASE_DIR, 'bench_baseline.json')
+
+SOURCE_CHAT_ID = -1001000000001   # 转发所有消息的群组
+MONITORED_CHAT_ID = -1001000000002  # 只处理指定 bot 的群组
+QUERY_BOT_ID = 777000
+QUERY_BOT_USERNAME = 'query_bot'
+TARGET_CHAT_ID = -1001000000003
+
+ENTRY_SEPARATOR = "----------------------------------------"
+
+def generate_entry(rng, index, eligible_ratio=0.6):
+    """生成一条查询结果，按比例生成满足/不满足筛选条件的条目"""
+    if rng.random() < eligible_ratio:
+        available_gb = rng.uniform(51, 2000)
+        days = rng.randint(21, 365)
+    else:
+        available_gb = rng.uniform(0, 50)
+        days = rng.randint(0, 20)
+    token = '%032x' % rng.getrandbits(128)
+    return (f"机场名称: 机场{index}\n"
+            f"剩余可用: {available_gb:.2f}GB\n"
+            f"剩余时间: {days}天{rng.randint(0, 23)}小时{rng.randint(0, 59)}分\n"
+            f"订阅链接: https://sub{index % 97}.example.com/api/v1/client/subscribe?token={token}\n")
+
+def generate_query_result(count, seed=0, title="查询结果"):
+    """生成包含 count 个条目的查询结果文本"""
+    rng = random.Random(seed)
+    parts = [f"{title}\n"]
+    for index in range(count):
+        parts.append(ENTRY_SEPARATOR + "\n")
+        parts.append(generate_entry(rng, index))
+    parts.append(ENTRY_SEPARATOR + "\n")
+    return ''.join(parts)
+
+class FakeFile:
+    def __init__(self, name, size, mime_type='text/plain'):
+        self.name = name
+        self.ext = os.path.splitext(name)[1]
+        self.size = size
+        self.mime_type = mime_type
+
+class FakeMessage:
+    def __init__(self, message_id, chat_id, sender_id, text, document=None, grouped_id=None):
+        self.id = message_id
+        self.chat_id = chat_id
+        self.sender_id = sender_id
+        self.text = text
+        self.message = text
+        self.grouped_id = grouped_id
+        self.document = document
+        self.media = document
+        self.file = FakeFile('result.txt', len(document)) if document is not None else None
+
+class FakeEvent:
+    def __init__(self, message, username=None):
+        self.message = message
+        self.chat_id = message.chat_id
+        self.sender_id = message.sender_id
+        self._username = username
+
+    async def get_sender(self):
+        return types.SimpleNamespace(id=self.sender_id, username=self._username)
+
+class FakeUserClient:
+    """模拟 TelegramClient：download_media 按配置的延迟写入媒体内容"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.download_calls = 0
+
+    async def get_entity(self, username):
+        return types.SimpleNamespace(id=QUERY_BOT_ID, username=username)
+
+    async def download_media(self, message, file=None):
+        self.download_calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        file.write(message.media)
+        return file
+
+def input_file_key(input_file):
+    """回放消息的标识写在文件内容的第一行"""
+    content = input_file.input_file_content
+    if not isinstance(content, bytes):
+        content.seek(0)
+        content = content.read()
+    return content.split(b'\n', 1)[0].decode('utf-8')
+
+class FakeDocument:
+    def __init__(self, file_id):
+        self.file_id = file_id
+
+class FakeSentMessage:
+    def __init__(self, file_id=None):
+        self.document = FakeDocument(file_id) if file_id else None
+
+class FakeBot:
+    """模拟 Bot：记录每次发送的完成时间，一次调用可能包含多条聚合后的消息"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.uploads = {}  # file_id -> 消息标识
+        self.sent = []  # (完成时间, 方法, 消息标识)
+
+    async def _complete(self, method, keys):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        finished = time.perf_counter()
+        self.sent.extend((finished, method, key) for key in keys)
+
+    def _document(self, document):
+        """返回 (消息标识, file_id)，已上传过的文件直接按 file_id 查找"""
+        if isinstance(document, str):
+            return self.uploads[document], document
+        key = input_file_key(document)
+        file_id = f"file-{len(self.uploads)}"
+        self.uploads[file_id] = key
+        return key, file_id
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._complete('send_message', re.findall(r'^#\d+', text, re.M))
+        return FakeSentMessage()
+
+    async def send_document(self, chat_id, document, **kwargs):
+        key, file_id = self._document(document)
+        await self._complete('send_document', [key])
+        return FakeSentMessage(file_id)
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        documents = [self._document(item.media) for item in media]
+        await self._complete('send_media_group', [key for key, _ in documents])
+        return [FakeSentMessage(file_id) for _, file_id in documents]
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+def summarize(latencies, items, elapsed=None):
+    """延迟统计（毫秒）和吞吐量（条目/秒），并发阶段传入实际经过的时间 elapsed"""
+    total = sum(latencies) if elapsed is None else elapsed
+    return {
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'throughput': round(items / total, 1) if total else 0.0,
+    }
+
+def write_bench_config(work_dir, args):
+    config = {
+        'API_ID': 0,
+        'API_HASH': 'bench',
+        'SOURCE_CHAT_IDS': [SOURCE_CHAT_ID, MONITORED_CHAT_ID],
+        'TARGET_CHAT_ID': TARGET_CHAT_ID,
+        'BOT_TOKEN': '0:bench',
+        'MONITORING_CHATS': {str(MONITORED_CHAT_ID): [QUERY_BOT_USERNAME]},
+        'EXTRACTED_TEXT_FILE': os.path.join(work_dir, 'dydz.txt'),
+        'DYDZ_TXT_PATH': os.path.join(work_dir, 'dydz.txt'),
+        'MD5_FILE_PATH': os.path.join(work_dir, 'dydz.md5'),
+        'LINK_META_FILE': os.path.join(work_dir, 'dydz.meta'),
+        'SESSION_FILE': os.path.join(work_dir, 'session'),
+        'DYNB_PY_PATH': os.path.join(BASE_DIR, 'dy', 'dymb.py'),
+        'ZYDY_YAML_PATH': os.path.join(work_dir, 'zydy.yaml'),
+        'FORWARD_WORKERS': args.workers,
+        'FORWARD_RATE_PER_MINUTE': 10 ** 9,
+        'FORWARD_BURST': 10 ** 9,
+        'FORWARD_QUEUE_SIZE': 10 ** 5,
+        'AGGREGATE_WINDOW_SECONDS': args.aggregate_window,
+        'METRICS_PORT': 0,
+        'PROBE_INTERVAL_SECONDS': 0,
+        'LOG_LEVEL': 'WARNING',
+    }
+    config_path = os.path.join(work_dir, 'config.json')
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump(config, f)
+    return config_path
+
+def bench_parse(bot, sizes):
+    results = {}
+    for size in sizes:
+        text = generate_query_result(size, seed=size)
+        repeats = max(1, min(50, 20000 // max(size, 1)))
+        latencies = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            bot.extract_entries(text)
+            latencies.append(time.perf_counter() - start)
+        results[f'parse.{size}'] = summarize(latencies, size * repeats)
+    return results
+
+async def bench_dedup(bot, batches, batch_size):
+    """去重：每批一半为已存在的链接"""
+    rng = random.Random(1)
+    seen = []
+    latencies = []
+    for batch_index in range(batches):
+        entries = []
+        for index in range(batch_size):
+            if seen and rng.random() < 0.5:
+                link = rng.choice(seen)
+            else:
+                link = f"https://dedup.example.com/sub?token={batch_index}-{index}"
+                seen.append(link)
+            entries.append(bot.LinkEntry(100.0, 30.0, link))
+        start = time.perf_counter()
+        bot.link_store.add(entries, SOURCE_CHAT_ID)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await bot.link_store.flush()
+    flush_latency = time.perf_counter() - start
+    results = {'dedup.add': summarize(latencies, batches * batch_size)}
+    results['dedup.flush'] = summarize([flush_latency], len(seen))
+    return results
+
+async def bench_forward(bot, fake_bot, events):
+    """回放消息：handler 耗时，以及从进入 handler 到机器人发送完成的端到端耗时
+
+    返回 (统计结果, 未送达的消息标识)；发送异常会被转发队列记录后丢弃，只能通过未送达的消息发现。
+    """
+    starts = {}
+    handler_latencies = []
+    for key, event in events:
+        start = time.perf_counter()
+        starts[key] = start
+        await bot.handler(event)
+        handler_latencies.append(time.perf_counter() - start)
+
+    await bot.aggregator.close()
+    await bot.forward_queue.close(timeout=600)
+    delivered = [(finished, key) for finished, _, key in fake_bot.sent if key in starts]
+    delivery_latencies = [finished - starts[key] for finished, key in delivered]
+    elapsed = max(finished for finished, _ in delivered) - min(starts.values()) if delivered else None
+    sent_keys = {key for _, key in delivered}
+    undelivered = [key for key, _ in events if key not in sent_keys]
+    print(f"回放 {len(events)} 条消息，Bot API 调用 {fake_bot.calls} 次")
+    return {
+        'forward.handler': summarize(handler_latencies, len(events)),
+        'forward.delivery': summarize(delivery_latencies, len(delivery_latencies), elapsed),
+    }, undelivered
+
+def build_events(count, entries_per_document):
+    """构造回放消息：一半来自转发所有消息的群组，一半来自监控群组中的查询 bot，其中一部分带查询结果文件"""
+    events = []
+    for index in range(count):
+        key = f"#{index}"
+        if index % 4 == 0 or index % 16 == 1:
+            # 每 16 条消息中连续的两份结果文件组成一个媒体组
+            document = generate_query_result(entries_per_document, seed=index, title=key).encode('utf-8')
+            grouped_id = index // 16 if index % 16 < 2 else None
+            message = FakeMessage(index, MONITORED_CHAT_ID, QUERY_BOT_ID, '', document=document,
+                                  grouped_id=grouped_id)
+            events.append((key, FakeEvent(message, QUERY_BOT_USERNAME)))
+        elif index % 4 == 1:
+            text = key + "\n" + generate_query_result(3, seed=index).split(ENTRY_SEPARATOR + "\n", 1)[1]
+            message = FakeMessage(index, MONITORED_CHAT_ID, QUERY_BOT_ID, text)
+            events.append((key, FakeEvent(message, QUERY_BOT_USERNAME)))
+        else:
+            message = FakeMessage(index, SOURCE_CHAT_ID, 1000 + index, f"{key}\n普通消息 {index}")
+            events.append((key, FakeEvent(message)))
+    return events
+
+def bench_render(bot, sizes):
+    results = {}
+    for size in sizes:
+        links = [f"https://render{index % 97}.example.com/sub?token={index}" for index in range(size)]
+        latencies = []
+        for repeat in range(5):
+            # 每次改变一条链接，确保配置确实需要重新写入
+            with open(bot.DYDZ_TXT_PATH, 'w', encoding='utf-8') as f:
+                f.write(''.join(link + '\n' for link in links[:-1]))
+                f.write(f"{links[-1]}-{repeat}\n")
+            start = time.perf_counter()
+            bot.update_subscriptions()
+            latencies.append(time.perf_counter() - start)
+        results[f'render.{size}'] = summarize(latencies, size * len(latencies))
+    return results
+
+async def run_benchmarks(bot, args):
+    results = {}
+    sizes = [10, 1000, 10000] if args.quick else [10, 1000, 10000, 100000]
+    results.update(bench_parse(bot, sizes))
+
+    bot.link_store.load()
+    commit_task = asyncio.ensure_future(bot.link_store.run())
+    results.update(await bench_dedup(bot, 20 if args.quick else 200, 100))
+
+    fake_user_client = FakeUserClient(args.download_latency)
+    fake_bot = FakeBot(args.send_latency)
+    bot.user_client = fake_user_client
+    bot.bot = fake_bot
+    await bot.resolve_routes()
+    bot.forward_queue.start()
+    events = build_events(200 if args.quick else 2000, 50)
+    forward_results, undelivered = await bench_forward(bot, fake_bot, events)
+    results.update(forward_results)
+
+    commit_task.cancel()
+    await asyncio.gather(commit_task, return_exceptions=True)
+    await bot.link_store.flush()
+
+    results.update(bench_render(bot, [100, 1000] if args.quick else [100, 1000, 10000]))
+    return results, undelivered
+
+def compare_with_baseline(results, baseline, tolerance, min_delta_ms):
+    """p99 延迟超过基线 (1 + tolerance) 倍即视为回退，绝对差值小于 min_delta_ms 的抖动忽略"""
+    regressions = []
+    for name, stats in results.items():
+        reference = baseline.get(name)
+        if not reference:
+            continue
+        limit = reference['p99_ms'] * (1 + tolerance)
+        if stats['p99_ms'] > limit and stats['p99_ms'] - reference['p99_ms'] > min_delta_ms:
+            regressions.append(f"{name}: p99 {stats['p99_ms']}ms > 基线 {reference['p99_ms']}ms × {1 + tolerance}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='bybot 离线回放与性能基准测试')
+    parser.add_argument('--quick', action='store_true', help='缩小规模，快速运行')
+    parser.add_argument('--workers', type=int, default=4, help='转发 worker 数量')
+    parser.add_argument('--download-latency', type=float, default=0.005, help='假 download_media 的延迟（秒）')
+    parser.add_argument('--send-latency', type=float, default=0.01, help='假 Bot API 调用的延迟（秒）')
+    parser.add_argument('--aggregate-window', type=float, default=0.05, help='消息聚合窗口（秒）')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='允许的 p99 回退比例')
+    parser.add_argument('--min-delta-ms', type=float, default=1.0, help='忽略小于该值的 p99 差异（毫秒）')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='基线文件路径')
+    parser.add_argument('--update-baseline', action='store_true', help='将本次结果写入基线文件')
+    parser.add_argument('--output', help='将本次结果以 JSON 写入该文件')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.environ['CONFIG_FILE_PATH'] = write_bench_config(work_dir, args)
+        sys.path.insert(0, BASE_DIR)
+        import bot
+
+        results, undelivered = asyncio.run(run_benchmarks(bot, args))
+
+    print(f"{'阶段':<20}{'p50(ms)':>12}{'p99(ms)':>12}{'吞吐量(条/秒)':>18}")
+    for name, stats in results.items():
+        print(f"{name:<20}{stats['p50_ms']:>12}{stats['p99_ms']:>12}{stats['throughput']:>18}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    baseline_key = 'quick' if args.quick else 'full'
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    if undelivered:
+        print(f"{len(undelivered)} 条回放消息未送达: {' '.join(undelivered[:20])}")
+        return 1
+
+    if args.update_baseline:
+        baseline[baseline_key] = results
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+        print(f"基线已更新: {args.baseline}")
+        return 0
+
+    regressions = compare_with_baseline(results, baseline.get(baseline_key, {}),
+                                        args.tolerance, args.min_delta_ms)
+    if regressions:
+        print("性能回退:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print("未发现性能回退")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,25 +1,124 @@
 import asyncio
+import atexit
+import base64
+import io
+import multiprocessing
 from telethon import TelegramClient, events
+from telethon.errors import FloodWaitError, RPCError
+from telethon.tl.types import MessageMediaWebPage
 import os
+import queue
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import json
 from datetime import datetime, timedelta
 import re
+import signal
 import hashlib
-import subprocess
+import heapq
+import importlib.util
+import tempfile
+import threading
 import time
+from collections import OrderedDict, deque, namedtuple
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
+from urllib.parse import quote, unquote, urlsplit, urlunsplit
+import httpx
 from filelock import FileLock
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
 
-# 配置日志
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.StreamHandler()  # 确保日志输出到标准输出
-    ]
-)
 logger = logging.getLogger(__name__)
 
+# 按组件划分的日志记录器，可在配置文件的 LOG_LEVELS 中分别设置级别
+ingest_logger = logging.getLogger('bot.ingest')    # 接收消息
+parse_logger = logging.getLogger('bot.parse')      # 解析查询结果
+forward_logger = logging.getLogger('bot.forward')  # 转发到目标群组
+watcher_logger = logging.getLogger('bot.watcher')  # 监控 dydz.txt
+render_logger = logging.getLogger('bot.render')    # 生成配置文件
+store_logger = logging.getLogger('bot.store')      # 链接存储
+probe_logger = logging.getLogger('bot.probe')      # 订阅探测
+
+# 日志中消息内容等载荷的最大长度
+LOG_PAYLOAD_MAX = 200
+
+class Payload:
+    """延迟截断的日志载荷，只有日志真正输出时才生成字符串"""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        text = str(self.value)
+        if len(text) > LOG_PAYLOAD_MAX:
+            return f"{text[:LOG_PAYLOAD_MAX]}...（共 {len(text)} 字）"
+        return text
+
+def kv(**fields):
+    """为日志记录附加结构化字段：logger.info("...", extra=kv(chat_id=...))"""
+    return {'fields': fields}
+
+class StructuredFormatter(logging.Formatter):
+    """text 格式在消息后追加 key=value 字段，json 格式每条记录输出一行 JSON"""
+
+    def __init__(self, log_format='text'):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        self.json = log_format == 'json'
+
+    @staticmethod
+    def format_value(value):
+        text = str(value)
+        if not text or any(c.isspace() or c == '=' for c in text):
+            return json.dumps(text, ensure_ascii=False)
+        return text
+
+    def format(self, record):
+        fields = getattr(record, 'fields', None) or {}
+        if self.json:
+            data = {
+                'time': self.formatTime(record),
+                'logger': record.name,
+                'level': record.levelname,
+                'message': record.getMessage(),
+            }
+            data.update(fields)
+            if record.exc_info:
+                data['exc_info'] = self.formatException(record.exc_info)
+            return json.dumps(data, ensure_ascii=False, default=str)
+
+        text = super().format(record)
+        if fields:
+            text += ' ' + ' '.join(f"{key}={self.format_value(value)}" for key, value in fields.items())
+        return text
+
+def setup_logging(config):
+    """日志通过 QueueHandler 交给后台线程输出，事件循环不会阻塞在 stdout 上"""
+    global LOG_PAYLOAD_MAX
+    LOG_PAYLOAD_MAX = config.get('LOG_PAYLOAD_MAX', LOG_PAYLOAD_MAX)
+
+    stream_handler = logging.StreamHandler()  # 确保日志输出到标准输出
+    stream_handler.setFormatter(StructuredFormatter(config.get('LOG_FORMAT', 'text')))
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(config.get('LOG_LEVEL', 'INFO'))
+
+    # 按组件设置日志级别，例如 {"parse": "DEBUG", "ingest": "WARNING"}
+    for component, level in config.get('LOG_LEVELS', {}).items():
+        logging.getLogger(f'bot.{component}').setLevel(level)
+    logging.getLogger('httpx').setLevel(logging.WARNING)  # 订阅探测时不逐条记录请求
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
 # 从配置文件读取配置
 def load_config():
     config_file_path = os.environ.get('CONFIG_FILE_PATH', '/app/config.json')
@@ -27,56 +126,358 @@ def load_config():
         with open(config_file_path, 'r') as config_file:
             return json.load(config_file)
     except Exception as e:
-        logger.error(f"读取配置文件出错: {e}")
+        logger.error("读取配置文件出错: %s", e)
         raise
 
 config = load_config()
+setup_logging(config)
 
 # 从配置文件获取配置
 API_ID = config.get('API_ID')
 API_HASH = config.get('API_HASH')
 SOURCE_CHAT_IDS = list(map(int, config.get('SOURCE_CHAT_IDS', [])))  # 默认为空列表
-TARGET_CHAT_ID = config.get('TARGET_CHAT_ID')
+TARGET_CHAT_ID = config.get('TARGET_CHAT_ID')  # 单个目标群组 ID，或目标群组 ID 列表
 BOT_TOKEN = config.get('BOT_TOKEN')
 
+def target_list(value):
+    """将单个目标或目标列表统一为整数列表"""
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [int(chat_id) for chat_id in value]
+    return [int(value)]
+
+TARGET_CHAT_IDS = target_list(TARGET_CHAT_ID)
+
+# 按来源群组单独指定目标群组，未指定的来源群组发送到 TARGET_CHAT_ID
+SOURCE_TARGETS = {int(chat_id): target_list(targets) for chat_id, targets in config.get('SOURCE_TARGETS', {}).items()}
+
 # 监控的群组及其对应的 bot 列表
 MONITORING_CHATS = config.get('MONITORING_CHATS', {})
 
+# 发送者信息缓存数量
+SENDER_CACHE_SIZE = config.get('SENDER_CACHE_SIZE', 1024)
+
+# 重复消息去重窗口（秒）和记录数量上限：窗口内发往相同目标的相同内容不再解析和转发，0 表示关闭
+DUPLICATE_WINDOW_SECONDS = config.get('DUPLICATE_WINDOW_SECONDS', 600)
+DUPLICATE_WINDOW_SIZE = config.get('DUPLICATE_WINDOW_SIZE', 4096)
+
 # 设置会话文件路径
 SESSION_FILE = config.get('SESSION_FILE', '/app/sessions/session_name')
 
-# 创建 Telegram 客户端
-user_client = TelegramClient(SESSION_FILE, API_ID, API_HASH)
+# 每个来源群组最后处理的消息 ID，与会话文件放在同一目录，重启后据此补抓停机期间的消息
+CHECKPOINT_FILE = config.get('CHECKPOINT_FILE', f"{SESSION_FILE}.checkpoint.json")
+CHECKPOINT_INTERVAL_SECONDS = config.get('CHECKPOINT_INTERVAL_SECONDS', 5)
+# 多进程模式下 worker 保存检查点前等待协调进程确认链接已写入的最长时间（秒），超时则下次再保存
+LINK_ACK_TIMEOUT_SECONDS = config.get('LINK_ACK_TIMEOUT_SECONDS', 5)
+
+# 补抓设置：每个群组最多补抓的消息数量（0 表示不补抓）、同时补抓的群组数量、每批处理的消息数量
+BACKFILL_MAX_MESSAGES = config.get('BACKFILL_MAX_MESSAGES', 5000)
+BACKFILL_CONCURRENCY = config.get('BACKFILL_CONCURRENCY', 4)
+BACKFILL_BATCH_SIZE = config.get('BACKFILL_BATCH_SIZE', 100)
+
+# 内容哈希 -> Bot API file_id 缓存，相同内容的文件不再重复上传
+FILE_ID_CACHE_FILE = config.get('FILE_ID_CACHE_FILE', f"{SESSION_FILE}.file_ids.json")
+FILE_ID_CACHE_SIZE = config.get('FILE_ID_CACHE_SIZE', 1024)
+FILE_ID_CACHE_SAVE_SECONDS = config.get('FILE_ID_CACHE_SAVE_SECONDS', 30)
+
+# Telegram 客户端和机器人客户端在 create_clients() 中创建，导入本模块时不会连接 Telegram
+user_client = None
+bot = None
+
+from telegram import Bot, InputFile, InputMediaDocument
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+# 媒体下载缓冲区大小上限（字节），超过后溢出到临时文件
+MEDIA_SPOOL_MAX_BYTES = config.get('MEDIA_SPOOL_MAX_BYTES', 8 * 1024 * 1024)
+
+# 下载解析的文本文件大小上限（字节），更大的文件不下载，按不需要解析的媒体处理
+MEDIA_PARSE_MAX_BYTES = config.get('MEDIA_PARSE_MAX_BYTES', 20 * 1024 * 1024)
+# 转发媒体的大小上限（字节），超过时直接跳过；0 表示不限制
+MEDIA_FORWARD_MAX_BYTES = config.get('MEDIA_FORWARD_MAX_BYTES', 0)
+# 开启后不需要解析的媒体由用户账号按引用转发，不下载到本地；用户账号需要能在目标群组发言，
+# 转发失败时改为下载后通过机器人发送。默认关闭，所有消息都由机器人发送
+MEDIA_FORWARD_BY_REFERENCE = config.get('MEDIA_FORWARD_BY_REFERENCE', False)
+
+# 需要下载解析的文本文件的 MIME 类型
+TEXT_MIME_TYPES = ('text/plain',)
+
+# 文字消息或媒体说明中出现任一关键词时才解析链接
+PARSE_KEYWORDS = config.get('PARSE_KEYWORDS', ['剩余可用'])
+PARSE_KEYWORDS_PATTERN = re.compile('|'.join(re.escape(keyword) for keyword in PARSE_KEYWORDS))
+
+# 转发队列配置：队列长度、并发发送数、每个目标每分钟发送上限、突发上限、最大重试次数
+FORWARD_QUEUE_SIZE = config.get('FORWARD_QUEUE_SIZE', 1000)
+FORWARD_WORKERS = config.get('FORWARD_WORKERS', 4)
+FORWARD_RATE_PER_MINUTE = config.get('FORWARD_RATE_PER_MINUTE', 20)
+FORWARD_BURST = config.get('FORWARD_BURST', 5)
+FORWARD_MAX_RETRIES = config.get('FORWARD_MAX_RETRIES', 5)
+FORWARD_DRAIN_TIMEOUT = config.get('FORWARD_DRAIN_TIMEOUT', 30)
+
+# 转发解析过的查询结果文件时使用的文件名，其他文件沿用原文件名
+FORWARD_FILENAME = "查询结果.txt"
 
-# 创建机器人客户端
-from telegram import Bot
-bot = Bot(BOT_TOKEN)
+# 消息聚合窗口（秒）：窗口内同一来源的连续文字消息合并发送，同一媒体组的文件一次发送
+AGGREGATE_WINDOW_SECONDS = config.get('AGGREGATE_WINDOW_SECONDS', 1.0)
+
+# Telegram 单条文字消息的长度上限和单个媒体组的文件数量上限
+TELEGRAM_TEXT_LIMIT = 4096
+TELEGRAM_MEDIA_GROUP_LIMIT = 10
+
+# 合并文字消息时使用的分隔符
+TEXT_JOIN_SEPARATOR = "\n\n"
 
 # 指定固定的文件路径，用于存储提取的文本内容
 EXTRACTED_TEXT_FILE = config.get('EXTRACTED_TEXT_FILE', '/app/extracted_text.txt')
 
+# 链接元数据文件路径（剩余流量、到期时间、来源群组、首次/最近发现时间）
+LINK_META_FILE = config.get('LINK_META_FILE', f"{EXTRACTED_TEXT_FILE}.meta")
+
+# 检查链接到期的最长间隔（秒）
+EVICT_MAX_SLEEP_SECONDS = config.get('EVICT_MAX_SLEEP_SECONDS', 300)
+
 # 监控的文件路径
 DYDZ_TXT_PATH = config.get('DYDZ_TXT_PATH', '/app/dydzt.txt')
 
 # MD5 文件存储路径
 MD5_FILE_PATH = config.get('MD5_FILE_PATH', '/app/dydzt.md5')
 
+# 订阅探测配置：探测间隔、总并发、单个域名并发、超时、User-Agent（部分机场只对 clash 类 UA 返回流量信息）
+PROBE_INTERVAL_SECONDS = config.get('PROBE_INTERVAL_SECONDS', 6 * 3600)
+PROBE_CONCURRENCY = config.get('PROBE_CONCURRENCY', 20)
+PROBE_PER_HOST_CONCURRENCY = config.get('PROBE_PER_HOST_CONCURRENCY', 2)
+PROBE_TIMEOUT_SECONDS = config.get('PROBE_TIMEOUT_SECONDS', 15)
+PROBE_USER_AGENT = config.get('PROBE_USER_AGENT', 'clash.meta')
+# 订阅地址连续多少次返回失效状态码后才删除，偶发的错误响应不会删除链接
+PROBE_FAILURES_BEFORE_DELETE = config.get('PROBE_FAILURES_BEFORE_DELETE', 3)
+
+# 订阅内容缓存：定期拉取订阅内容（ETag/If-Modified-Since 条件请求），合并去重后生成本地节点文件，
+# 配置文件引用该文件而不是各个订阅地址；0 表示不启用（默认）。并发数和超时沿用探测的设置
+SUBSCRIPTION_REFRESH_SECONDS = config.get('SUBSCRIPTION_REFRESH_SECONDS', 0)
+SUBSCRIPTION_CACHE_DIR = config.get('SUBSCRIPTION_CACHE_DIR', '/app/dy/cache')
+SUBSCRIPTION_MERGED_PATH = config.get('SUBSCRIPTION_MERGED_PATH', '/app/dy/merged.txt')
+# 配置文件中引用合并节点文件的路径（mihomo 看到的路径，必须位于 mihomo 的 home 目录下），启用时必须配置
+SUBSCRIPTION_MERGED_PROVIDER_PATH = config.get('SUBSCRIPTION_MERGED_PROVIDER_PATH')
+# 使用通用客户端的 User-Agent，机场返回 base64 编码的节点链接列表
+SUBSCRIPTION_USER_AGENT = config.get('SUBSCRIPTION_USER_AGENT', 'v2rayN/6.42')
+MERGED_PROVIDER_NAME = '合并节点'
+# 合并节点文件的分片数量：每个订阅固定写入一个分片，某个订阅变化时只重写它所在的分片文件
+SUBSCRIPTION_MERGED_SHARDS = config.get('SUBSCRIPTION_MERGED_SHARDS', 1)
+
+# dydz.txt 变化的防抖时间和最大处理延迟（秒）
+WATCH_DEBOUNCE_SECONDS = config.get('WATCH_DEBOUNCE_SECONDS', 1.0)
+WATCH_MAX_LATENCY_SECONDS = config.get('WATCH_MAX_LATENCY_SECONDS', 5.0)
+
 # dymb.py 文件路径
 DYNB_PY_PATH = config.get('DYNB_PY_PATH', '/app/dymb.py')
 
-# dymb.py 中的 subscriptions 数组的代码片段
-DYNB_PY_SUBSCRIPTIONS_TEMPLATE = """
-subscriptions = [
-    {subscriptions}
-]
-"""
+# 生成的配置文件路径
+ZYDY_YAML_PATH = config.get('ZYDY_YAML_PATH', '/app/dy/zydy.yaml')
+
+# 监控指标 HTTP 服务地址，端口为 0 时不启动
+METRICS_HOST = config.get('METRICS_HOST', '0.0.0.0')
+METRICS_PORT = config.get('METRICS_PORT', 9100)
+
+# 多进程模式：每个会话文件对应一个 worker 进程，来源群组按 chat_id 分片到各 worker；
+# 主进程作为协调进程统一负责链接去重、写入链接文件和重新生成配置。为空时单进程运行
+WORKER_SESSIONS = config.get('WORKER_SESSIONS', [])
+WORKER_CHECK_SECONDS = config.get('WORKER_CHECK_SECONDS', 5)
+WORKER_MAX_RESTART_DELAY = config.get('WORKER_MAX_RESTART_DELAY', 300)
+
+# 延迟直方图的默认分桶（秒）
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+class Counter:
+    """Prometheus 计数器"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Gauge:
+    """Prometheus 仪表盘，数值在输出时通过回调获取"""
+
+    def __init__(self, name, documentation, callback):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+
+    def render(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge",
+                f"{self.name} {self.callback()}"]
+
+class Histogram:
+    """Prometheus 直方图"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # 标签 -> [各分桶计数, 总和, 总数]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """统计代码块的耗时，同步和异步代码中均可使用"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (bucket_counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    labels = format_labels(self.labelnames, key, [('le', bound)])
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = format_labels(self.labelnames, key, [('le', '+Inf')])
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {count}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = metrics.register(Histogram('bybot_handler_seconds', '处理一条消息的端到端耗时'))
+DOWNLOAD_SECONDS = metrics.register(Histogram('bybot_download_media_seconds', 'download_media 耗时'))
+SEND_SECONDS = metrics.register(Histogram('bybot_send_seconds', 'Bot API 发送耗时', ['method']))
+PARSE_SECONDS = metrics.register(Histogram('bybot_parse_seconds', '解析查询结果耗时'))
+RENDER_SECONDS = metrics.register(Histogram('bybot_render_seconds', '生成配置文件耗时'))
+EVENT_LOOP_LAG_SECONDS = metrics.register(Histogram('bybot_event_loop_lag_seconds', '事件循环调度延迟'))
+LINKS_TOTAL = metrics.register(Counter('bybot_links_total', '解析出的条目数量，按结果和原因分类', ['result', 'reason']))
+DUPLICATE_LINKS_TOTAL = metrics.register(Counter('bybot_duplicate_links_total', '已存在于链接存储中的链接数量'))
+FORWARD_FAILURES_TOTAL = metrics.register(Counter('bybot_forward_failures_total', '转发失败次数', ['reason']))
+COALESCED_MESSAGES_TOTAL = metrics.register(Counter('bybot_coalesced_messages_total', '因聚合而节省的 Bot API 调用次数', ['kind']))
+FILE_ID_CACHE_TOTAL = metrics.register(Counter('bybot_file_id_cache_total', 'file_id 缓存查询次数，按命中/未命中/失效分类', ['result']))
+BACKFILL_MESSAGES_TOTAL = metrics.register(Counter('bybot_backfill_messages_total', '重启后补抓处理的消息数量'))
+DUPLICATES_SUPPRESSED_TOTAL = metrics.register(Counter('bybot_duplicates_suppressed_total', '去重窗口内跳过的重复消息数量', ['kind']))
+MEDIA_FILTER_TOTAL = metrics.register(Counter('bybot_media_filter_total', '媒体预筛选的处理方式', ['decision']))
+SUBSCRIPTION_FETCH_TOTAL = metrics.register(Counter('bybot_subscription_fetch_total', '拉取订阅内容的次数，按结果分类', ['result']))
+WATCHER_TRIGGERS_TOTAL = metrics.register(Counter('bybot_watcher_triggers_total', 'dydz.txt 变化触发检查的次数'))
+
+async def handle_metrics_request(reader, writer):
+    """极简 HTTP 服务，只响应 GET /metrics"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 10)
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 10)
+            if line in (b'\r\n', b'\n', b''):
+                break
+
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status = '200 OK'
+            body = metrics.render().encode('utf-8')
+        else:
+            status = '404 Not Found'
+            body = b'not found\n'
+        writer.write((f"HTTP/1.1 {status}\r\n"
+                      "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                      f"Content-Length: {len(body)}\r\n"
+                      "Connection: close\r\n\r\n").encode('latin-1') + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def monitor_event_loop_lag(interval=0.5):
+    """测量事件循环的调度延迟"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - start - interval))
+
+async def run_metrics_server(port=METRICS_PORT):
+    """在同一个事件循环中提供 /metrics 接口"""
+    if not port:
+        return
+    server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, port)
+    logger.info("监控指标服务已启动: http://%s:%s/metrics", METRICS_HOST, port)
+    async with server:
+        await monitor_event_loop_lag()
+
+# 查询结果中条目之间的分隔线
+ENTRY_SEPARATOR = "----------------------------------------"
+
+# 正则表达式模式：匹配“剩余时间: XX天”、“剩余时间: XX天XX小时”、“剩余时间: XX天XX小时XX分”、“剩余时间: XX天XX小时XX分XX秒”
+REMAINING_DAYS_PATTERN = re.compile(r'剩余时间:\s*(\d+)天(?:(\d+)小时)?(?:(\d+)分)?(?:(\d+)秒)?')
+
+# 一次扫描识别行内的字段关键字
+FIELD_PATTERN = re.compile(r'剩余可用|剩余时间|订阅链接')
+
+# 订阅链接的值：标签后的第一个非空白片段
+LINK_VALUE_PATTERN = re.compile(r'订阅链接\s*[:：]\s*(\S+)')
+
+# 订阅 token 所在的查询参数，去重时只看主机名和 token
+SUBSCRIPTION_TOKEN_PARAMS = ('token',)
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# 已经是规范形式的常见链接（小写主机名、无端口），只需检查查询参数顺序
+CANONICAL_LINK_PATTERN = re.compile(r'https?://[a-z0-9-]+(?:\.[a-z0-9-]+)*/[^?#\s]*(?:\?[^#\s]*)?')
+
+# 链接筛选条件
+MIN_AVAILABLE_GB = 50.00
+MIN_REMAINING_DAYS = 20
+
+# 解析出的单个查询结果条目
+LinkEntry = namedtuple('LinkEntry', ['available_gb', 'remaining_days', 'link'])
 
 def extract_remaining_days(text):
-    logger.info("开始提取剩余时间")
+    parse_logger.debug("开始提取剩余时间")
     
-    # 正则表达式模式：匹配“剩余时间: XX天”、“剩余时间: XX天XX小时”、“剩余时间: XX天XX小时XX分”、“剩余时间: XX天XX小时XX分XX秒”
-    pattern = r'剩余时间:\s*(\d+)天(?:(\d+)小时)?(?:(\d+)分)?(?:(\d+)秒)?'
-    match = re.search(pattern, text)
+    match = REMAINING_DAYS_PATTERN.search(text)
     
     if match:
         days = int(match.group(1))
@@ -86,324 +487,2544 @@ def extract_remaining_days(text):
         
         # 转换为总天数（浮点数形式）
         total_days = days + hours / 24 + minutes / (24 * 60) + seconds / (24 * 60 * 60)
-        logger.info(f"提取到剩余时间: {days}天{hours}小时{minutes}分{seconds}秒，总计{total_days:.4f}天")
+        parse_logger.debug("提取到剩余时间: %d天%d小时%d分%d秒，总计%.4f天", days, hours, minutes, seconds, total_days)
         
         return total_days
     else:
-        logger.info("未找到剩余时间或格式不符合要求")
+        parse_logger.debug("未找到剩余时间或格式不符合要求")
         return None
 
-def extract_links(text):
-    logger.info("开始提取链接")
-    logger.info(f"读取到的文件内容:\n{text}")  # 打印文件内容到日志
-    
-    links = []
-    # 按照 "----------------------------------------" 分割文本
-    entries = text.split("----------------------------------------")
-    for entry in entries:
-        if not entry.strip():
-            continue
-        
-        lines = entry.strip().split('\n')
-        available_gb = None
-        remaining_days = None
-        link = None
-        
-        for line in lines:
-            if '剩余可用' in line:
-                available_gb_str = line.split(':')[-1].strip().replace('GB', '')
+def iter_entries(source):
+    """流式解析查询结果，逐条产出 LinkEntry
+
+    source 可以是文字消息字符串、文本/二进制文件对象或任意按行迭代的对象，
+    逐行读取，不会把整个文件加载到内存。
+    """
+    if isinstance(source, str):
+        source = io.StringIO(source)
+
+    available_gb = None
+    remaining_days = None
+    link = None
+    has_content = False
+
+    for line in source:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace')
+
+        # 分隔线可能与内容处在同一行，按分隔线切开逐段处理
+        parts = line.split(ENTRY_SEPARATOR) if ENTRY_SEPARATOR in line else (line,)
+        for index, part in enumerate(parts):
+            if index > 0:
+                if has_content:
+                    yield LinkEntry(available_gb, remaining_days, link)
+                available_gb = None
+                remaining_days = None
+                link = None
+                has_content = False
+
+            if not part.strip():
+                continue
+            has_content = True
+
+            fields = FIELD_PATTERN.findall(part)
+            if not fields:
+                continue
+
+            if '剩余可用' in fields:
+                available_gb_str = part.split(':')[-1].strip().replace('GB', '')
                 try:
                     available_gb = float(available_gb_str)
-                    logger.info(f"检查剩余可用: {available_gb} GB")
+                    parse_logger.debug("检查剩余可用: %s GB", available_gb)
                 except ValueError:
-                    logger.info(f"无法转换剩余可用值: {available_gb_str}")
-            
-            if '剩余时间' in line:
-                remaining_days = extract_remaining_days(line)
-            
-            if '订阅链接' in line:
-                link = line.split(':')[-1].strip()
-                if link.startswith('//'):
-                    link = 'http:' + link  # 或者使用 'https:'，根据实际情况选择
-                logger.info(f"找到订阅链接: {link}")
-        
-        # 检查条件并添加链接
-        if available_gb is not None and available_gb > 50.00 and remaining_days is not None and remaining_days > 20:
-            logger.info(f"符合条件: 链接={link}, 剩余可用={available_gb} GB, 剩余时间={remaining_days:.2f}天")
-            links.append(link)
-        else:
-            if available_gb is None:
-                logger.info("剩余可用信息未找到或格式错误，跳过此条目")
-            if remaining_days is None:
-                logger.info("剩余时间信息未找到或格式错误，跳过此条目")
-            if link is None:
-                logger.info("订阅链接未找到，跳过此条目")
-    
-    logger.info(f"提取到的链接数量: {len(links)}")
-    return links
+                    parse_logger.debug("无法转换剩余可用值: %s", available_gb_str)
 
-def deduplicate_links(file_path):
-    """去除文件中的重复链接"""
-    if not os.path.exists(file_path):
-        logger.info(f"文件 {file_path} 不存在，无需去重")
-        return
-    
-    # 读取文件内容
-    with open(file_path, 'r', encoding='utf-8') as f:
-        links = f.readlines()
-    
-    # 去重
-    unique_links = list(dict.fromkeys(links))  # 保留顺序并去重
+            if '剩余时间' in fields:
+                remaining_days = extract_remaining_days(part)
+
+            if '订阅链接' in fields:
+                match = LINK_VALUE_PATTERN.search(part)
+                link = match.group(1) if match else part.split(':')[-1].strip()
+                parse_logger.debug("找到订阅链接: %s", link)
+
+    if has_content:
+        yield LinkEntry(available_gb, remaining_days, link)
+
+def canonical_link(link):
+    """规范化订阅链接：小写 scheme 和主机名，去掉默认端口、末尾的点和片段，查询参数排序"""
+    link = link.strip()
+    if CANONICAL_LINK_PATTERN.fullmatch(link):
+        query = link.partition('?')[2]
+        if '&' not in query:
+            return link
+        params = query.split('&')
+        if params == sorted(params):
+            return link
+    if link.startswith('//'):
+        link = 'http:' + link  # 或者使用 'https:'，根据实际情况选择
+    try:
+        parts = urlsplit(link)
+        port = parts.port
+    except ValueError:
+        return link
+    if not parts.netloc or not parts.hostname:
+        return link
+
+    scheme = parts.scheme.lower()
+    host = parts.hostname.rstrip('.')
+    if ':' in host:
+        host = f"[{host}]"  # IPv6 地址
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{port}"
+    if '@' in parts.netloc:
+        host = parts.netloc.rsplit('@', 1)[0] + '@' + host
+    query = parts.query
+    if '&' in query:
+        query = '&'.join(sorted(query.split('&')))
+    return urlunsplit((scheme, host, parts.path or '/', query, ''))
+
+def link_key(link):
+    """订阅的去重键：主机名 + 订阅 token，不区分 http/https；没有 token 参数时使用路径和查询参数
+
+    link 需已经过 canonical_link 规范化（scheme://主机/路径?查询参数），这里按字符串切分，不再完整解析。
+    """
+    scheme, sep, rest = link.partition('://')
+    if not sep:
+        return link
+    netloc, _, rest = rest.partition('/')
+    path, _, query = rest.partition('?')
+    host = netloc.rsplit('@', 1)[-1]
+    for param in query.split('&'):
+        name, _, value = param.partition('=')
+        if value and name.lower() in SUBSCRIPTION_TOKEN_PARAMS:
+            return f"{host}|{value}"
+    return f"{host}|/{path.rstrip('/')}?{query}"
+
+def is_https_upgrade(link, stored):
+    """link 是已保存的 http 链接 stored 的 https 写法"""
+    return link.startswith('https://') and stored.startswith('http://')
+
+def rejection_reason(entry):
+    """返回条目不满足筛选条件的原因，满足条件时返回 None"""
+    if entry.link is None:
+        return 'no_link'
+    if entry.available_gb is None:
+        return 'no_quota'
+    if entry.remaining_days is None:
+        return 'no_remaining_days'
+    if entry.available_gb <= MIN_AVAILABLE_GB:
+        return 'low_quota'
+    if entry.remaining_days <= MIN_REMAINING_DAYS:
+        return 'expiring'
+    return None
+
+def is_entry_eligible(entry):
+    """检查条目是否满足剩余流量和剩余时间的筛选条件"""
+    return rejection_reason(entry) is None
+
+def extract_entries(source):
+    """从文字消息或文件对象中提取符合条件的条目"""
+    parse_logger.debug("开始提取链接")
     
-    # 写回文件
-    with open(file_path, 'w', encoding='utf-8') as f:
-        for link in unique_links:
-            f.write(link)
+    entries = []
+    with PARSE_SECONDS.time():
+        for entry in iter_entries(source):
+            # 检查条件并添加链接
+            reason = rejection_reason(entry)
+            if reason is None:
+                entry = entry._replace(link=canonical_link(entry.link))
+                parse_logger.debug("符合条件", extra=kv(link=entry.link, available_gb=entry.available_gb,
+                                                     remaining_days=round(entry.remaining_days, 2)))
+                LINKS_TOTAL.inc(result='accepted')
+                entries.append(entry)
+            else:
+                LINKS_TOTAL.inc(result='rejected', reason=reason)
+                if entry.available_gb is None:
+                    parse_logger.debug("剩余可用信息未找到或格式错误，跳过此条目")
+                if entry.remaining_days is None:
+                    parse_logger.debug("剩余时间信息未找到或格式错误，跳过此条目")
+                if entry.link is None:
+                    parse_logger.debug("订阅链接未找到，跳过此条目")
     
-    logger.info(f"已去除文件 {file_path} 中的重复链接，最终链接数量: {len(unique_links)}")
+    parse_logger.info("提取到的链接数量: %d", len(entries))
+    return entries
 
-@user_client.on(events.NewMessage(chats=SOURCE_CHAT_IDS))
-async def handler(event):
-    # 获取消息文本和文件
-    message_text = event.message.text
-    media = event.message.media
+def extract_links(source):
+    """从文字消息或文件对象中提取符合条件的链接"""
+    return [entry.link for entry in extract_entries(source)]
 
-    # 检查消息是否来自指定的 bot 和指定的群组
-    sender = await event.get_sender()
-    chat_id = str(event.chat_id)  # 将 chat_id 转换为字符串以便与配置文件中的值比较
+def entry_expires_at(entry, now):
+    """根据剩余时间计算到期时间戳，不过期时返回 None"""
+    if entry.remaining_days is None or entry.remaining_days == float('inf'):
+        return None
+    return now + entry.remaining_days * 86400
 
-    # 记录消息内容
-    logger.info(f"捕获到新消息: {message_text}")
-    logger.info(f"消息来自群组: {chat_id}, 发送者: {sender.username}")
+def write_file_atomic(path, data):
+    """写入同目录下的临时文件后原子替换"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
 
-    # 如果是需要监控 bot 的特定群组
-    if chat_id in MONITORING_CHATS:
-        logger.info(f"消息来自监控的群组: {chat_id}")
-        if sender.username in MONITORING_CHATS[chat_id]:
-            logger.info(f"消息来自指定的 bot: {sender.username}")
+class LinkStore:
+    """订阅链接存储：启动时加载一次建立内存索引，新链接批量提交（一次 fsync）
+
+    链接文件只保存链接本身，供 dymb.py 读取；每条链接的剩余流量、到期时间、来源群组、
+    首次/最近发现时间以 JSON 行的形式保存在元数据文件中，后写入的记录覆盖先前的记录。
+    去重按 link_key（主机名 + 订阅 token）进行，同一订阅的不同写法只保留最先出现的链接，
+    但 https 写法会替换已保存的 http 写法（旧版本解析时会把 https 链接写成 http）。
+    已有链接再次出现时也会追加元数据记录，元数据文件行数超过链接数量的 compact_ratio 倍时压缩。
+    启动后手动追加到链接文件的链接在重写文件前合并到索引中，不会因删除或压缩而丢失。
+    """
+
+    def __init__(self, file_path, meta_path, commit_delay=0.5, compact_ratio=4):
+        self.file_path = file_path
+        self.meta_path = meta_path
+        self.lock = FileLock(f"{file_path}.lock")  # 与 monitor_dydzt 共用同一把文件锁
+        self.commit_delay = commit_delay  # 攒批等待时间（秒）
+        self.compact_ratio = compact_ratio
+        self._meta_lines = 0  # 元数据文件当前的行数
+        self._links = {}  # 保留插入顺序的哈希索引，值为元数据记录（无元数据时为 None）
+        self._keys = {}  # link_key -> 已保存的链接
+        self._pending = []
+        self._pending_meta = {}
+        self._pending_event = None
+        self._write_lock = None  # 串行化追加与重写，避免重写后再追加出重复行
+        self._expiry_heap = []  # (到期时间, 链接) 最小堆，过期记录惰性删除
+        self._fingerprint = None  # 最近一次读取或写入后链接文件的指纹
+        self._external_changes = False  # 追加时发现链接文件被其他程序修改过
+        self._needs_rewrite = False  # 已写入文件的链接被替换，下次提交时需要重写文件
+
+    def __contains__(self, link):
+        return link_key(link) in self._keys
+
+    def resolve(self, link):
+        """返回与 link 属于同一订阅的已保存链接，不存在时返回 link 本身"""
+        return self._keys.get(link_key(link), link)
+
+    def __len__(self):
+        return len(self._links)
+
+    def links(self):
+        return list(self._links)
+
+    def metadata(self, link):
+        return self._links.get(link)
+
+    def _get_write_lock(self):
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        return self._write_lock
+
+    def load(self):
+        """加载链接文件和元数据到内存索引，存在重复时压缩文件"""
+        with self.lock:
+            if not os.path.exists(self.file_path):
+                store_logger.info("文件 %s 不存在，无需加载", self.file_path)
+                self._links = {}
+                self._keys = {}
+                self._fingerprint = None
+                return
+
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                lines = [line.strip() for line in f]
+            self._keys = {}
+            rewritten = 0
+            for line in lines:
+                if not line:
+                    continue
+                link = canonical_link(line)
+                if link != line:
+                    rewritten += 1
+                key = link_key(link)
+                stored = self._keys.get(key)
+                if stored is None or is_https_upgrade(link, stored):
+                    self._keys[key] = link
+            self._links = dict.fromkeys(self._keys.values())
+
+            meta_lines = 0
+            if os.path.exists(self.meta_path):
+                with open(self.meta_path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        meta_lines += 1
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue
+                        if not isinstance(record.get('link'), str):
+                            continue
+                        link = self._keys.get(link_key(canonical_link(record['link'])))
+                        if link is not None:
+                            record['link'] = link
+                            self._links[link] = record
+
+            # 只有存在重复行、空行、未规范化的链接或被覆盖的元数据时才重写文件
+            meta_count = sum(1 for record in self._links.values() if record is not None)
+            self._meta_lines = meta_lines
+            if len(self._links) != len(lines) or rewritten or meta_lines != meta_count:
+                self._compact(list(self._links.items()))
+                store_logger.info("已压缩文件 %s，去除 %d 行重复或空行", self.file_path, len(lines) - len(self._links))
+            self._fingerprint = file_fingerprint(self.file_path)
+            self._external_changes = False
+            self._needs_rewrite = False
+
+        self._rebuild_expiry_heap()
+        store_logger.info("已加载链接文件 %s，链接数量: %d", self.file_path, len(self._links))
+
+    def _compact(self, items):
+        """通过临时文件 + 原子替换重写链接文件和元数据文件，调用方需持有文件锁"""
+        write_file_atomic(self.file_path, ''.join(link + '\n' for link, _ in items).encode('utf-8'))
+        records = [record for _, record in items if record is not None]
+        write_file_atomic(self.meta_path, ''.join(json.dumps(record, ensure_ascii=False) + '\n'
+                                                  for record in records).encode('utf-8'))
+        self._meta_lines = len(records)
+        self._fingerprint = file_fingerprint(self.file_path)
+
+    def _update_record(self, link, record):
+        self._links[link] = record
+        self._pending_meta[link] = record
+        if record.get('expires_at') is not None:
+            heapq.heappush(self._expiry_heap, (record['expires_at'], link))
+
+    def _notify_pending(self):
+        if self._pending_event is not None:
+            self._pending_event.set()
+
+    def add(self, entries, source_chat=None, now=None):
+        """将条目加入索引并排队等待提交，已存在的链接只更新元数据，返回实际新增的链接"""
+        now = time.time() if now is None else now
+        new_links = []
+        for entry in entries:
+            # 同一订阅的不同写法映射到最先保存的链接，https 写法替换已保存的 http 链接
+            key = link_key(entry.link)
+            link = self._keys.setdefault(key, entry.link)
+            if is_https_upgrade(entry.link, link):
+                link = self._upgrade_link(key, link, entry.link, new_links)
+            record = self._links.get(link)
+            if link not in self._links:
+                new_links.append(link)
+            if record is None:
+                record = {'link': link, 'source_chat': source_chat, 'first_seen': now}
+            else:
+                record = dict(record)
+            record['available_gb'] = entry.available_gb
+            record['expires_at'] = entry_expires_at(entry, now)
+            record['last_seen'] = now
+            self._update_record(link, record)
+
+        self._pending.extend(new_links)
+        if entries:
+            self._notify_pending()
+        return new_links
+
+    def _upgrade_link(self, key, old, new, new_links):
+        """用 new 替换已保存的链接 old，old 已写入文件时下次提交改为重写文件"""
+        record = self._links.pop(old)
+        self._links[new] = dict(record, link=new) if record is not None else None
+        self._keys[key] = new
+        self._pending_meta.pop(old, None)
+        for pending in (new_links, self._pending):
+            if old in pending:
+                pending[pending.index(old)] = new
+                return new
+        self._needs_rewrite = True
+        store_logger.info("订阅链接 %s 替换为 https 写法", old)
+        return new
+
+    def update_quota(self, entries, now=None):
+        """更新已有链接的剩余流量和到期时间（例如订阅探测的结果）"""
+        now = time.time() if now is None else now
+        for entry in entries:
+            link = self.resolve(entry.link)
+            if link not in self._links:
+                continue
+            record = dict(self._links[link] or {'link': link})
+            record['available_gb'] = entry.available_gb
+            record['expires_at'] = entry_expires_at(entry, now)
+            # 探测成功，清除连续失败次数
+            record.pop('probe_failures', None)
+            self._update_record(link, record)
+        self._notify_pending()
+
+    def record_probe_failures(self, links):
+        """累加链接连续探测失败的次数，返回 链接 -> 连续失败次数"""
+        counts = {}
+        for link in links:
+            link = self.resolve(link)
+            if link not in self._links:
+                continue
+            record = dict(self._links[link] or {'link': link})
+            record['probe_failures'] = record.get('probe_failures', 0) + 1
+            self._update_record(link, record)
+            counts[link] = record['probe_failures']
+        self._notify_pending()
+        return counts
+
+    def _rebuild_expiry_heap(self):
+        self._expiry_heap = [(record['expires_at'], link) for link, record in self._links.items()
+                             if record is not None and record.get('expires_at') is not None]
+        heapq.heapify(self._expiry_heap)
+
+    def _is_current(self, expires_at, link):
+        record = self._links.get(link)
+        return record is not None and record.get('expires_at') == expires_at
+
+    def next_expiry(self):
+        """返回最早的到期时间，不存在时返回 None"""
+        # 更新或删除过的链接会在堆中留下过期记录，堆过大时整体重建
+        if len(self._expiry_heap) > 2 * len(self._links) + 64:
+            self._rebuild_expiry_heap()
+        while self._expiry_heap:
+            expires_at, link = self._expiry_heap[0]
+            if self._is_current(expires_at, link):
+                return expires_at
+            heapq.heappop(self._expiry_heap)
+        return None
+
+    def pop_expired(self, now=None):
+        """弹出所有已到期的链接，只检查堆顶，不扫描整个集合"""
+        now = time.time() if now is None else now
+        expired = []
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expires_at, link = heapq.heappop(self._expiry_heap)
+            if self._is_current(expires_at, link):
+                expired.append(link)
+        return expired
+
+    async def remove(self, links):
+        """从索引中删除链接并重写链接文件，返回实际删除的链接"""
+        removed = [link for link in dict.fromkeys(map(self.resolve, links)) if link in self._links]
+        if not removed:
+            return removed
+
+        for link in removed:
+            del self._links[link]
+            del self._keys[link_key(link)]
+
+        async with self._get_write_lock():
+            await self._rewrite_all(removed)
+        store_logger.info("已从固定文件 %s 中删除 %d 条链接", self.file_path, len(removed))
+        return removed
+
+    async def _rewrite_all(self, removed=()):
+        """按当前索引重写链接文件和元数据文件，调用方需持有写入锁
+
+        重写的内容已包含所有待提交的链接和元数据；写入失败时下次提交再重写。
+        """
+        self._pending = []
+        self._pending_meta = {}
+        self._needs_rewrite = False
+        snapshot = list(self._links.items())
+        loop = asyncio.get_running_loop()
+        try:
+            external = await loop.run_in_executor(None, self._rewrite, snapshot, removed)
+        except BaseException:
+            self._needs_rewrite = True
+            raise
+        self._merge_external(external)
+
+    def _read_external(self, items, removed):
+        """链接文件中不在 items 里、也不是本次删除的链接，即启动后由其他程序或手动追加的链接"""
+        known = {link_key(link) for link, _ in items}
+        known.update(link_key(link) for link in removed)
+        external = []
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    link = canonical_link(line)
+                    key = link_key(link)
+                    if key not in known:
+                        known.add(key)
+                        external.append(link)
+        except FileNotFoundError:
+            pass
+        return external
+
+    def _rewrite(self, items, removed=()):
+        """重写链接文件，文件被其他程序修改过时保留其中新增的链接，返回这些链接"""
+        with self.lock:
+            external = []
+            if self._external_changes or file_fingerprint(self.file_path) != self._fingerprint:
+                external = self._read_external(items, removed)
+                self._external_changes = False
+            self._compact(items + [(link, None) for link in external])
+            return external
+
+    def _merge_external(self, external):
+        """将重写时保留的外部链接加入索引"""
+        for link in external:
+            key = link_key(link)
+            if key not in self._keys:
+                self._keys[key] = link
+                self._links[link] = None
+        if external:
+            store_logger.info("链接文件 %s 在启动后被修改过，已保留新增的 %d 条链接", self.file_path, len(external))
+
+    def _append(self, batch, records):
+        with self.lock:
+            if batch:
+                if file_fingerprint(self.file_path) != self._fingerprint:
+                    self._external_changes = True
+                with open(self.file_path, 'a', encoding='utf-8') as f:
+                    f.write(''.join(link + '\n' for link in batch))
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._fingerprint = file_fingerprint(self.file_path)
+            if records:
+                with open(self.meta_path, 'a', encoding='utf-8') as f:
+                    f.write(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records))
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._meta_lines += len(records)
+
+    async def flush(self):
+        """提交所有待写入的链接和元数据，全部写入文件后返回 True，写入失败时返回 False"""
+        async with self._get_write_lock():
+            if self._needs_rewrite:
+                try:
+                    await self._rewrite_all()
+                    store_logger.info("已重写固定文件 %s", self.file_path)
+                except Exception as e:
+                    store_logger.error("重写链接文件出错: %s", e)
+                    return False
+                return True
+            if not self._pending and not self._pending_meta:
+                return True
+            batch, self._pending = self._pending, []
+            records, self._pending_meta = self._pending_meta, {}
+            loop = asyncio.get_running_loop()
             try:
-                if media:
-                    # 下载文件
-                    file_path = await user_client.download_media(media)
-                    # 通过机器人发送文件并指定文件名
-                    await bot.send_document(TARGET_CHAT_ID, open(file_path, 'rb'), filename="查询结果.txt")
-                    logger.info(f"指定 bot 的文件消息已通过机器人发送到目标群组")
-                    
-                    # 提取文本文件内容并筛选链接
-                    if file_path.endswith('.txt'):  # 确保是文本文件
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            text = f.read()
-                        links = extract_links(text)
-                        if links:
-                            # 重新加载已有的链接
-                            written_links = set()
-                            if os.path.exists(EXTRACTED_TEXT_FILE):
-                                with open(EXTRACTED_TEXT_FILE, 'r', encoding='utf-8') as f:
-                                    written_links.update(line.strip() for line in f.readlines())
-                            
-                            # 写入新的链接，避免重复
-                            new_links = []
-                            for link in links:
-                                if link not in written_links:
-                                    new_links.append(link)
-                                    written_links.add(link)
-                            
-                            if new_links:
-                                with open(EXTRACTED_TEXT_FILE, 'a', encoding='utf-8') as f:
-                                    for link in new_links:
-                                        f.write(link + '\n')
-                                    logger.info(f"已将符合条件的链接追加到固定文件: {EXTRACTED_TEXT_FILE}")
-                            else:
-                                logger.info("提取到的链接已全部写入，没有新的链接")
-                        else:
-                            logger.info("未找到符合条件的链接")
-                    
-                    # 删除下载的文件
-                    os.remove(file_path)
-                    logger.info(f"已删除下载的文件: {file_path}")
-                else:
-                    # 处理文字消息
-                    text = message_text
-                    # 检查是否符合预定格式
-                    if '剩余可用' in text:
-                        logger.info("捕获到符合预定格式的文字消息")
-                        links = extract_links(text)
-                        if links:
-                            # 重新加载已有的链接
-                            written_links = set()
-                            if os.path.exists(EXTRACTED_TEXT_FILE):
-                                with open(EXTRACTED_TEXT_FILE, 'r', encoding='utf-8') as f:
-                                    written_links.update(line.strip() for line in f.readlines())
-                            
-                            # 写入新的链接，避免重复
-                            new_links = []
-                            for link in links:
-                                if link not in written_links:
-                                    new_links.append(link)
-                                    written_links.add(link)
-                            
-                            if new_links:
-                                with open(EXTRACTED_TEXT_FILE, 'a', encoding='utf-8') as f:
-                                    for link in new_links:
-                                        f.write(link + '\n')
-                                    logger.info(f"已将符合条件的链接追加到固定文件: {EXTRACTED_TEXT_FILE}")
-                            else:
-                                logger.info("提取到的链接已全部写入，没有新的链接")
-                        else:
-                            logger.info("文字消息未找到符合条件的链接")
-                    else:
-                        logger.info("文字消息不符合预定格式，跳过处理")
-                    
-                    # 转发文字消息到目标群组
-                    await bot.send_message(TARGET_CHAT_ID, message_text)
-                    logger.info(f"指定 bot 的文字消息已通过机器人发送到目标群组: {message_text}")
+                await loop.run_in_executor(None, self._append, batch, list(records.values()))
+                if batch:
+                    store_logger.info("已将 %d 条符合条件的链接追加到固定文件: %s", len(batch), self.file_path)
+            except Exception as e:
+                # 写入失败时放回队列，等待下一次提交
+                self._pending[:0] = batch
+                for link, record in records.items():
+                    self._pending_meta.setdefault(link, record)
+                store_logger.error("追加链接到文件出错: %s", e)
+                return False
+
+            # 重复出现的链接不断追加元数据记录，行数过多时压缩，避免文件无限增长；
+            # 链接已经追加成功，压缩失败时下次提交再重写
+            if self._meta_lines > self.compact_ratio * len(self._links) + 64:
+                meta_lines = self._meta_lines
+                try:
+                    await self._rewrite_all()
+                    store_logger.info("已压缩元数据文件 %s，%d 行 -> %d 行", self.meta_path, meta_lines, self._meta_lines)
+                except Exception as e:
+                    store_logger.error("压缩元数据文件出错: %s", e)
+            return True
+
+    async def run(self):
+        """后台提交任务：攒批后统一写入"""
+        self._pending_event = asyncio.Event()
+        if self._pending or self._pending_meta or self._needs_rewrite:
+            self._pending_event.set()
+        while True:
+            await self._pending_event.wait()
+            await asyncio.sleep(self.commit_delay)
+            self._pending_event.clear()
+            await self.flush()
+
+link_store = LinkStore(EXTRACTED_TEXT_FILE, LINK_META_FILE)
+metrics.register(Gauge('bybot_links', '链接存储中的链接数量', lambda: len(link_store)))
+
+class WorkerLinks:
+    """worker 进程中解析出的条目：按序号发送给协调进程，协调进程写入链接存储后确认已提交的序号
+
+    确认消息带有 worker 的进程 ID，重启后的 worker 不会收到上一个进程的确认。
+    """
+
+    def __init__(self, queue, acks):
+        self.queue = queue
+        self.acks = acks
+        self.pid = os.getpid()
+        self.sent = 0  # 已发送的最大序号
+        self.committed = 0  # 协调进程确认已写入的最大序号
+        self._committed_event = None
+
+    def put(self, source_chat, entries):
+        self.sent += 1
+        self.queue.put((self.pid, self.sent, source_chat, [tuple(entry) for entry in entries]))
+
+    def start_receiver(self, loop):
+        """在线程中读取协调进程的确认，交给事件循环处理"""
+        self._committed_event = asyncio.Event()
+
+        def receive():
+            while True:
+                try:
+                    pid, seq = self.acks.get()
+                except (EOFError, OSError):
+                    return  # 队列已关闭
+                if pid != self.pid:
+                    continue
+                try:
+                    loop.call_soon_threadsafe(self._commit, seq)
+                except RuntimeError:
+                    return  # 事件循环已关闭
+
+        threading.Thread(target=receive, name='link-ack-receiver', daemon=True).start()
+
+    def _commit(self, seq):
+        if seq > self.committed:
+            self.committed = seq
+            self._committed_event.set()
+
+    async def flush(self, timeout):
+        """等待协调进程确认目前为止发送的所有条目都已写入，超时返回 False"""
+        target = self.sent
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.committed < target:
+            self._committed_event.clear()
+            try:
+                await asyncio.wait_for(self._committed_event.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+# worker 进程中解析出的条目由它交给协调进程，单进程模式和协调进程中为 None
+worker_links = None
+
+def save_links(entries, source_chat=None):
+    """将符合条件的条目加入链接存储，避免重复"""
+    if worker_links is not None:
+        worker_links.put(source_chat, entries)
+        return
+    new_links = link_store.add(entries, source_chat)
+    if len(entries) > len(new_links):
+        DUPLICATE_LINKS_TOTAL.inc(len(entries) - len(new_links))
+    if new_links:
+        store_logger.info("新增 %d 条符合条件的链接，等待写入固定文件", len(new_links),
+                          extra=kv(source_chat=source_chat))
+    else:
+        store_logger.info("提取到的链接已全部写入，没有新的链接", extra=kv(source_chat=source_chat))
+
+async def run_evictor():
+    """按到期时间顺序删除已过期的链接，一次删除只重写一次文件，从而只触发一次配置重新生成"""
+    while True:
+        now = time.time()
+        expired = link_store.pop_expired(now)
+        if expired:
+            store_logger.info("%d 条链接已到期，从固定文件中删除", len(expired))
+            try:
+                await link_store.remove(expired)
             except Exception as e:
-                logger.error(f"发送指定 bot 的消息出错: {e}")
+                store_logger.error("删除到期链接时出错: %s", e)
+
+        next_expiry = link_store.next_expiry()
+        if next_expiry is None:
+            delay = EVICT_MAX_SLEEP_SECONDS
         else:
-            logger.info(f"消息不是来自指定的 bot 列表，跳过复制")
-    # 如果是其他监控的群组，则正常转发所有消息
+            delay = min(max(next_expiry - now, 1), EVICT_MAX_SLEEP_SECONDS)
+        await asyncio.sleep(delay)
+
+def parse_subscription_userinfo(header):
+    """解析 subscription-userinfo 响应头，例如 upload=0; download=0; total=107374182400; expire=1735660800"""
+    info = {}
+    for part in header.split(';'):
+        key, sep, value = part.partition('=')
+        if not sep:
+            continue
+        try:
+            info[key.strip().lower()] = int(float(value.strip()))
+        except ValueError:
+            continue
+    return info
+
+def userinfo_entry(link, info, now=None):
+    """将 subscription-userinfo 转换为 LinkEntry，expire 缺失或为 0 表示不过期"""
+    available_gb = None
+    if 'total' in info:
+        used = info.get('upload', 0) + info.get('download', 0)
+        available_gb = (info['total'] - used) / 1024 ** 3
+
+    expire = info.get('expire')
+    if expire:
+        now = time.time() if now is None else now
+        remaining_days = (expire - now) / 86400
     else:
+        remaining_days = float('inf')
+    return LinkEntry(available_gb, remaining_days, link)
+
+# 订阅探测结果：status 为 ok（满足条件）、failed（不满足条件，或 entry 为 None 时表示返回了失效状态码）
+# 或 unknown（无法判断，保留）
+ProbeResult = namedtuple('ProbeResult', ['link', 'status', 'entry', 'reason'])
+
+# 表示订阅已失效的 HTTP 状态码；403 经常是防火墙或限流的响应，按无法判断处理
+PROBE_DEAD_STATUS = {401, 404, 410}
+
+def create_http_client(concurrency, timeout, user_agent):
+    """订阅探测和订阅内容缓存共用的 httpx 客户端"""
+    return httpx.AsyncClient(
+        timeout=timeout,
+        limits=httpx.Limits(max_connections=concurrency),
+        headers={'User-Agent': user_agent},
+        follow_redirects=True,
+    )
+
+class SubscriptionProber:
+    """并发请求订阅地址，根据 subscription-userinfo 重新检查剩余流量和剩余时间"""
+
+    def __init__(self, concurrency, per_host_concurrency, timeout, user_agent):
+        self.concurrency = concurrency
+        self.per_host_concurrency = per_host_concurrency
+        self.timeout = timeout
+        self.user_agent = user_agent
+
+    def create_client(self):
+        return create_http_client(self.concurrency, self.timeout, self.user_agent)
+
+    async def probe(self, client, link, host_semaphores):
+        host = (urlsplit(link).hostname or '').lower()
+        semaphore = host_semaphores.setdefault(host, asyncio.Semaphore(self.per_host_concurrency))
+        async with semaphore:
+            try:
+                # 只读取响应头，不下载订阅内容
+                async with client.stream('GET', link) as response:
+                    status_code = response.status_code
+                    header = response.headers.get('subscription-userinfo')
+            except httpx.HTTPError as e:
+                return ProbeResult(link, 'unknown', None, f"请求失败: {e!r}")
+
+        if status_code in PROBE_DEAD_STATUS:
+            return ProbeResult(link, 'failed', None, f"HTTP {status_code}")
+        if status_code >= 400 or not header:
+            return ProbeResult(link, 'unknown', None, f"HTTP {status_code}，无 subscription-userinfo")
+
+        entry = userinfo_entry(link, parse_subscription_userinfo(header))
+        if entry.available_gb is None:
+            return ProbeResult(link, 'unknown', entry, "subscription-userinfo 缺少 total")
+        if is_entry_eligible(entry):
+            return ProbeResult(link, 'ok', entry, "")
+        return ProbeResult(link, 'failed', entry,
+                           f"剩余可用={entry.available_gb:.2f} GB, 剩余时间={entry.remaining_days:.2f}天")
+
+    async def probe_all(self, links, client=None):
+        """并发探测所有链接，client 可传入自定义的 httpx.AsyncClient"""
+        host_semaphores = {}
+        if client is not None:
+            return await asyncio.gather(*(self.probe(client, link, host_semaphores) for link in links))
+        async with self.create_client() as client:
+            return await asyncio.gather(*(self.probe(client, link, host_semaphores) for link in links))
+
+subscription_prober = SubscriptionProber(PROBE_CONCURRENCY, PROBE_PER_HOST_CONCURRENCY,
+                                         PROBE_TIMEOUT_SECONDS, PROBE_USER_AGENT)
+
+async def prune_links():
+    """探测所有已保存的链接，删除不再满足条件的链接
+
+    剩余流量或剩余时间不满足条件的链接立即删除；返回失效状态码的链接连续失败
+    PROBE_FAILURES_BEFORE_DELETE 次后才删除。
+    """
+    links = link_store.links()
+    if not links:
+        return []
+    results = await subscription_prober.probe_all(links)
+
+    failed = [result for result in results if result.status == 'failed']
+    link_store.update_quota([result.entry for result in results if result.status == 'ok'])
+    failures = link_store.record_probe_failures([result.link for result in failed if result.entry is None])
+    removed = []
+    for result in failed:
+        if result.entry is None:
+            count = failures.get(link_store.resolve(result.link), 0)
+            if count < PROBE_FAILURES_BEFORE_DELETE:
+                probe_logger.info("订阅请求失败 %d/%d 次，暂不删除", count, PROBE_FAILURES_BEFORE_DELETE,
+                                  extra=kv(link=result.link, reason=result.reason))
+                continue
+        probe_logger.info("订阅已不满足条件，删除", extra=kv(link=result.link, reason=result.reason))
+        removed.append(result.link)
+    unknown = sum(1 for result in results if result.status == 'unknown')
+    probe_logger.info("订阅探测完成: 共 %d 条，删除 %d 条，无法判断 %d 条", len(results), len(removed), unknown)
+
+    # 删除后 dydz.txt 发生变化，由 monitor_dydzt 触发配置重新生成
+    return await link_store.remove(removed)
+
+async def run_prober():
+    """后台定期探测订阅"""
+    if PROBE_INTERVAL_SECONDS <= 0:
+        return
+    while True:
+        await asyncio.sleep(PROBE_INTERVAL_SECONDS)
         try:
-            if media:
-                file_path = await user_client.download_media(media)
-                await bot.send_document(TARGET_CHAT_ID, open(file_path, 'rb'), filename="查询结果.txt")
-                logger.info(f"文件消息已通过机器人发送到目标群组")
-                
-                # 提取文本文件内容并筛选链接
-                if file_path.endswith('.txt'):  # 确保是文本文件
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        text = f.read()
-                    links = extract_links(text)
-                    if links:
-                        # 重新加载已有的链接
-                        written_links = set()
-                        if os.path.exists(EXTRACTED_TEXT_FILE):
-                            with open(EXTRACTED_TEXT_FILE, 'r', encoding='utf-8') as f:
-                                written_links.update(line.strip() for line in f.readlines())
-                        
-                        # 写入新的链接，避免重复
-                        new_links = []
-                        for link in links:
-                            if link not in written_links:
-                                new_links.append(link)
-                                written_links.add(link)
-                        
-                        if new_links:
-                            with open(EXTRACTED_TEXT_FILE, 'a', encoding='utf-8') as f:
-                                for link in new_links:
-                                    f.write(link + '\n')
-                                logger.info(f"已将符合条件的链接追加到固定文件: {EXTRACTED_TEXT_FILE}")
-                        else:
-                            logger.info("提取到的链接已全部写入，没有新的链接")
-                    else:
-                        logger.info("未找到符合条件的链接")
-                
-                # 删除下载的文件
-                os.remove(file_path)
-                logger.info(f"已删除下载的文件: {file_path}")
-            else:
-                await bot.send_message(TARGET_CHAT_ID, message_text)
-                logger.info(f"消息已通过机器人发送到目标群组: {message_text}")
+            await prune_links()
         except Exception as e:
-            logger.error(f"发送消息出错: {e}")
+            probe_logger.error("探测订阅时出错: %s", e)
 
-async def main():
-    await user_client.start()
-    logger.info("监控已启动")
-    await user_client.run_until_disconnected()
+def shard_index(value, count):
+    """按稳定哈希把 value 分配到 count 个分片之一，与进程和列表顺序无关"""
+    digest = hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count
 
-def calculate_md5(file_path):
-    """计算文件的 MD5 值"""
-    md5_hash = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            md5_hash.update(chunk)
-    return md5_hash.hexdigest()
+def shard_path(path, index, count):
+    """第 index 个分片文件的路径，只有一个分片时就是 path 本身"""
+    if count == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}_{index + 1}{ext}"
 
-def update_subscriptions():
-    """更新 dymb.py 文件中的 subscriptions 数组并执行脚本"""
+# 订阅内容中可识别的节点链接协议
+NODE_SCHEMES = frozenset(['vmess', 'vless', 'trojan', 'ss', 'ssr', 'hysteria', 'hysteria2', 'hy2',
+                          'tuic', 'wireguard', 'wg', 'anytls', 'socks', 'socks5'])
+
+def node_scheme(node):
+    scheme, sep, _ = node.partition('://')
+    scheme = scheme.lower()
+    return scheme if sep and scheme in NODE_SCHEMES else None
+
+def b64decode_text(text):
+    """解码 base64 文本（兼容 URL 安全字符、换行和缺失的填充），失败时返回 None"""
+    data = ''.join(text.split()).replace('-', '+').replace('_', '/')
+    data += '=' * (-len(data) % 4)
     try:
-        # 读取 dydz.txt 文件中的订阅地址
-        with open(DYDZ_TXT_PATH, 'r', encoding='utf-8') as f:
-            links = [line.strip() for line in f.readlines() if line.strip()]
-        
-        # 准备 subscriptions 数组的内容
-        subscriptions_content = []
-        for index, link in enumerate(links):
-            subscription_entry = f"{{'name': '机场_{index + 1}', 'url': '{link}'}}"
-            subscriptions_content.append(subscription_entry)
-        
-        # 读取原始 dymb.py 文件内容
-        with open(DYNB_PY_PATH, 'r', encoding='utf-8') as f:
-            original_content = f.read()
-        
-        # 构建新的 subscriptions 数组代码
-        new_subscriptions_code = DYNB_PY_SUBSCRIPTIONS_TEMPLATE.format(
-            subscriptions=','.join(subscriptions_content)
-        )
-        
-        # 替换原始文件中的 subscriptions 数组
-        new_content = re.sub(
-            r'subscriptions = \[\s*.*?\s*\]',
-            new_subscriptions_code.strip(),
-            original_content,
-            flags=re.DOTALL
-        )
-        
-        # 将修改后的内容写回 dymb.py 文件
-        with open(DYNB_PY_PATH, 'w', encoding='utf-8') as f:
-            f.write(new_content)
-        
-        logger.info("subscriptions 数组已更新")
-        
-        # 执行 dymb.py 文件
-        subprocess.run(['python', DYNB_PY_PATH], check=True)
-        logger.info("dymb.py 脚本已执行")
-    except Exception as e:
-        logger.error(f"更新 subscriptions 或执行脚本时出错: {e}")
+        return base64.b64decode(data, validate=True).decode('utf-8')
+    except (ValueError, UnicodeDecodeError):
+        return None
 
-async def monitor_dydzt():
-    """监控 dydz.txt 文件的 MD5 变化"""
-    last_md5 = None
-    lock = FileLock(f"{DYDZ_TXT_PATH}.lock")
-    
-    while True:
+def decode_nodes(body):
+    """解析订阅内容中的节点链接，支持 base64 编码和纯文本的节点列表，无法识别时返回 None"""
+    text = body.decode('utf-8', errors='replace') if isinstance(body, bytes) else body
+    nodes = [line.strip() for line in text.splitlines() if node_scheme(line.strip())]
+    if not nodes:
+        decoded = b64decode_text(text)
+        if decoded is None:
+            return None
+        nodes = [line.strip() for line in decoded.splitlines() if node_scheme(line.strip())]
+    return nodes or None
+
+def vmess_config(node):
+    """vmess 链接的内容是 base64 编码的 JSON，无法解析时返回 None"""
+    decoded = b64decode_text(node.partition('://')[2])
+    try:
+        config = json.loads(decoded) if decoded else None
+    except ValueError:
+        return None
+    return config if isinstance(config, dict) else None
+
+def node_identity(node):
+    """节点的去重键：去掉节点名称后的链接内容"""
+    scheme = node_scheme(node)
+    if scheme == 'vmess':
+        config = vmess_config(node)
+        if config is not None:
+            config.pop('ps', None)
+            return 'vmess://' + json.dumps(config, sort_keys=True, ensure_ascii=False)
+    return f"{scheme}://{node.partition('://')[2].partition('#')[0]}"
+
+def node_name(node):
+    if node_scheme(node) == 'vmess':
+        config = vmess_config(node)
+        if config is not None:
+            return str(config.get('ps', ''))
+    return unquote(node.partition('#')[2])
+
+def rename_node(node, name):
+    if node_scheme(node) == 'vmess':
+        config = vmess_config(node)
+        if config is not None:
+            config['ps'] = name
+            return 'vmess://' + base64.b64encode(json.dumps(config, ensure_ascii=False).encode('utf-8')).decode('ascii')
+    return node.partition('#')[0] + '#' + quote(name)
+
+def merge_nodes(node_lists):
+    """合并多个机场的节点：内容相同的节点只保留第一个，重名的节点在名称后追加机场名称
+
+    node_lists 为 (机场名称, 节点链接列表) 的列表，返回 (合并后的节点列表, 去掉的重复节点数量)。
+    """
+    identities = set()
+    names = set()
+    merged = []
+    duplicates = 0
+    for airport, nodes in node_lists:
+        for node in nodes:
+            identity = node_identity(node)
+            if identity in identities:
+                duplicates += 1
+                continue
+            identities.add(identity)
+
+            name = node_name(node) or airport
+            if name in names:
+                base_name = name = f"{name} ({airport})"
+                suffix = 2
+                while name in names:
+                    name = f"{base_name} {suffix}"
+                    suffix += 1
+                node = rename_node(node, name)
+            names.add(name)
+            merged.append(node)
+    return merged, duplicates
+
+class SubscriptionCache:
+    """订阅内容的本地缓存
+
+    并发拉取所有订阅（每个主机限制并发数），响应体保存在缓存目录中，下次拉取时带上
+    If-None-Match/If-Modified-Since，内容未变化时服务器只返回 304。拉取失败时沿用缓存的内容。
+    所有订阅的节点合并去重后写入本地节点文件，配置文件通过 file 类型的 proxy-provider 引用它；
+    无法解析出节点的订阅仍以远程地址的形式写入配置文件。
+    shards 大于 1 时按订阅地址把节点分到多个文件中，在各分片内去重，只重写内容变化的分片。
+    """
+
+    def __init__(self, cache_dir, merged_path, concurrency, per_host_concurrency, timeout, user_agent, shards=1):
+        self.cache_dir = cache_dir
+        self.merged_path = merged_path
+        self.shards = max(1, shards)
+        self.concurrency = concurrency
+        self.per_host_concurrency = per_host_concurrency
+        self.timeout = timeout
+        self.user_agent = user_agent
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.state_path = os.path.join(cache_dir, 'merged.json')  # 上次生成的本地节点文件的状态
+        self._index = {}  # 订阅链接 -> {'etag': ..., 'last_modified': ...}
+        self._merged_digests = {}  # 分片序号 -> 已写入内容的哈希
+        self._refresh_event = None
+        self.merged_links = frozenset()  # 节点已合并到本地节点文件中的订阅
+        self.merged_shards = ()  # 包含节点的分片序号
+        self.node_count = 0
+
+    def load(self):
         try:
-            with lock:  # 使用文件锁避免并发问题
-                current_md5 = calculate_md5(DYDZ_TXT_PATH)
-                
-                if last_md5 != current_md5:
-                    logger.info(f"检测到 dydz.txt 文件内容发生变化，MD5 值: {current_md5}")
-                    last_md5 = current_md5
-                    update_subscriptions()
-        except Exception as e:
-            logger.error(f"监控 dydz.txt 文件时出错: {e}")
-        
-        await asyncio.sleep(5)  # 每5秒检查一次
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self._index = json.load(f)
+        except FileNotFoundError:
+            self._index = {}
+        except ValueError as e:
+            probe_logger.error("读取订阅缓存索引 %s 出错: %s，将重新拉取", self.index_path, e)
+            self._index = {}
+        self._load_state()
 
-if __name__ == "__main__":
-    # 去除文件中的重复链接
-    deduplicate_links(EXTRACTED_TEXT_FILE)
-    
-    # 确保目标文件存在
-    if not os.path.exists(DYDZ_TXT_PATH):
+    def _load_state(self):
+        """恢复上次合并的订阅，重启后生成的配置文件与重启前一致，不会先写入远程订阅再改回合并节点"""
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            merged_shards = tuple(state['shards'])
+            digests = {int(index): digest for index, digest in state['digests'].items()}
+            merged_links = frozenset(state['links'])
+        except FileNotFoundError:
+            return
+        except (ValueError, KeyError, TypeError) as e:
+            probe_logger.error("读取合并节点状态 %s 出错: %s", self.state_path, e)
+            return
+        # 状态与分片设置不一致或节点文件已丢失时，等待下一次刷新重新生成
+        if any(index >= self.shards or not os.path.exists(shard_path(self.merged_path, index, self.shards))
+               for index in merged_shards):
+            return
+        self.merged_links = merged_links
+        self.merged_shards = merged_shards
+        self._merged_digests = digests
+
+    def create_client(self):
+        return create_http_client(self.concurrency, self.timeout, self.user_agent)
+
+    def body_path(self, link):
+        return os.path.join(self.cache_dir, hashlib.blake2b(link.encode('utf-8'), digest_size=16).hexdigest())
+
+    async def fetch(self, client, link, host_semaphores):
+        """拉取单个订阅，返回 (链接, 结果, 响应体, 校验信息)，结果为 ok、not_modified 或 failed"""
+        headers = {}
+        cached = self._index.get(link)
+        if cached is not None:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        host = (urlsplit(link).hostname or '').lower()
+        semaphore = host_semaphores.setdefault(host, asyncio.Semaphore(self.per_host_concurrency))
+        async with semaphore:
+            try:
+                response = await client.get(link, headers=headers)
+            except httpx.HTTPError as e:
+                probe_logger.warning("拉取订阅失败: %r", e, extra=kv(link=link))
+                return link, 'failed', None, None
+
+        if response.status_code == 304 and cached is not None:
+            return link, 'not_modified', None, None
+        if response.status_code != 200:
+            probe_logger.warning("拉取订阅失败: HTTP %d", response.status_code, extra=kv(link=link))
+            return link, 'failed', None, None
+        validators = {'etag': response.headers.get('etag'), 'last_modified': response.headers.get('last-modified')}
+        return link, 'ok', response.content, validators
+
+    def _read_body(self, link):
+        try:
+            with open(self.body_path(link), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _rebuild(self, links, results):
+        """在线程池中执行：保存新的响应体，解析所有订阅的节点并重新生成本地节点文件"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        node_lists = [[] for _ in range(self.shards)]
+        merged_links = set()
+        for index, (link, result, body, validators) in enumerate(results):
+            if result == 'ok':
+                write_file_atomic(self.body_path(link), body)
+                self._index[link] = validators
+            else:
+                body = self._read_body(link)
+                if body is None:
+                    self._index.pop(link, None)
+            nodes = decode_nodes(body) if body is not None else None
+            if nodes:
+                # 与 dymb.build_subscriptions 的命名一致
+                node_lists[shard_index(link, self.shards)].append((f'机场_{index + 1}', nodes))
+                merged_links.add(link)
+
+        # 清理已删除订阅的缓存
+        for link in set(self._index) - set(links):
+            del self._index[link]
+            try:
+                os.remove(self.body_path(link))
+            except FileNotFoundError:
+                pass
+        write_file_atomic(self.index_path, json.dumps(self._index, ensure_ascii=False).encode('utf-8'))
+
+        changed = merged_links != self.merged_links
+        merged_shards = []
+        node_count = 0
+        duplicates = 0
+        for index, shard_lists in enumerate(node_lists):
+            merged, shard_duplicates = merge_nodes(shard_lists)
+            node_count += len(merged)
+            duplicates += shard_duplicates
+            if merged:
+                merged_shards.append(index)
+            data = ''.join(node + '\n' for node in merged).encode('utf-8')
+            digest = hashlib.sha256(data).hexdigest()
+            if digest != self._merged_digests.get(index):
+                write_file_atomic(shard_path(self.merged_path, index, self.shards), data)
+                self._merged_digests[index] = digest
+                changed = True
+        changed = changed or tuple(merged_shards) != self.merged_shards
+        self.merged_links = frozenset(merged_links)
+        self.merged_shards = tuple(merged_shards)
+        self.node_count = node_count
+        if changed:
+            state = {'links': sorted(merged_links), 'shards': merged_shards, 'digests': self._merged_digests}
+            write_file_atomic(self.state_path, json.dumps(state, ensure_ascii=False).encode('utf-8'))
+        return changed, node_count, duplicates
+
+    async def refresh(self, links=None, client=None):
+        """拉取所有订阅并重新生成本地节点文件，返回本地节点文件或已合并的订阅是否发生变化"""
+        loop = asyncio.get_running_loop()
+        if links is None:
+            links = await loop.run_in_executor(None, dymb.read_links, DYDZ_TXT_PATH)
+        host_semaphores = {}
+        if client is not None:
+            results = await asyncio.gather(*(self.fetch(client, link, host_semaphores) for link in links))
+        else:
+            async with self.create_client() as client:
+                results = await asyncio.gather(*(self.fetch(client, link, host_semaphores) for link in links))
+
+        for _, result, _, _ in results:
+            SUBSCRIPTION_FETCH_TOTAL.inc(result=result)
+        changed, node_count, duplicates = await loop.run_in_executor(None, self._rebuild, links, results)
+        probe_logger.info("订阅内容已刷新: 共 %d 条，更新 %d 条，未变化 %d 条，失败 %d 条；合并节点 %d 个，去除重复节点 %d 个",
+                          len(results), sum(1 for r in results if r[1] == 'ok'),
+                          sum(1 for r in results if r[1] == 'not_modified'),
+                          sum(1 for r in results if r[1] == 'failed'), node_count, duplicates)
+        return changed
+
+    def request_refresh(self):
+        """dydz.txt 变化后提前刷新"""
+        if self._refresh_event is not None:
+            self._refresh_event.set()
+
+    async def run(self, interval):
+        self._refresh_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        while True:
+            self._refresh_event.clear()
+            try:
+                if await self.refresh():
+                    await loop.run_in_executor(None, regenerate_config)
+            except Exception as e:
+                probe_logger.error("刷新订阅内容时出错: %s", e)
+            try:
+                await asyncio.wait_for(self._refresh_event.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+subscription_cache = SubscriptionCache(SUBSCRIPTION_CACHE_DIR, SUBSCRIPTION_MERGED_PATH, PROBE_CONCURRENCY,
+                                       PROBE_PER_HOST_CONCURRENCY, PROBE_TIMEOUT_SECONDS, SUBSCRIPTION_USER_AGENT,
+                                       SUBSCRIPTION_MERGED_SHARDS)
+metrics.register(Gauge('bybot_merged_nodes', '本地节点文件中的节点数量', lambda: subscription_cache.node_count))
+
+async def run_subscription_cache():
+    """后台定期刷新订阅内容缓存"""
+    if SUBSCRIPTION_REFRESH_SECONDS <= 0:
+        return
+    if not SUBSCRIPTION_MERGED_PROVIDER_PATH:
+        probe_logger.error("已设置 SUBSCRIPTION_REFRESH_SECONDS 但未配置 SUBSCRIPTION_MERGED_PROVIDER_PATH，订阅内容缓存未启用")
+        return
+    subscription_cache.load()
+    await subscription_cache.run(SUBSCRIPTION_REFRESH_SECONDS)
+
+def is_text_document(message):
+    """根据消息元数据判断媒体是否为文本文件"""
+    file = message.file
+    if file is None:
+        return False
+    if (file.mime_type or '').split(';')[0].strip() in TEXT_MIME_TYPES:
+        return True
+    return file.ext == '.txt' or (file.name or '').endswith('.txt')
+
+def classify_media(message):
+    """只根据消息元数据决定媒体的处理方式，不下载任何内容
+
+    返回 'text'（网页预览，按文字消息处理）、'parse'（下载后解析并发送）、
+    'forward'（不需要解析，直接转发）或 'skip'（超过转发大小上限）。
+    """
+    if isinstance(message.media, MessageMediaWebPage):
+        return 'text'
+    file = message.file
+    size = (file.size if file is not None else None) or 0
+    if MEDIA_FORWARD_MAX_BYTES and size > MEDIA_FORWARD_MAX_BYTES:
+        return 'skip'
+    if is_text_document(message) and size <= MEDIA_PARSE_MAX_BYTES:
+        return 'parse'
+    return 'forward'
+
+def media_filename(message):
+    """媒体的原文件名；没有文件名时（例如照片）按 MIME 类型补上扩展名"""
+    file = message.file
+    if file is not None and file.name:
+        return file.name
+    return f"media{(file.ext if file is not None else None) or ''}"
+
+async def download_media_buffer(message):
+    """将消息中的媒体下载到缓冲区，超过阈值时自动溢出到临时文件"""
+    buffer = tempfile.SpooledTemporaryFile(max_size=MEDIA_SPOOL_MAX_BYTES)
+    try:
+        with DOWNLOAD_SECONDS.time():
+            await user_client.download_media(message, file=buffer)
+    except BaseException:
+        buffer.close()
+        raise
+    buffer.seek(0)
+    return buffer
+
+def media_input_file(buffer, filename, attach=False):
+    """构造发送用的 InputFile：小文件直接使用内存数据，溢出到磁盘的大文件按句柄流式上传
+
+    attach 为 True 时以附件形式引用，用于媒体组。
+    """
+    size = buffer.seek(0, io.SEEK_END)
+    buffer.seek(0)
+    if size > MEDIA_SPOOL_MAX_BYTES:
+        return InputFile(buffer, filename=filename, attach=attach, read_file_handle=False)
+    return InputFile(buffer.read(), filename=filename, attach=attach)
+
+def media_group_item(media, filename):
+    """构造媒体组中的单个文件，media 为缓冲区或已上传文件的 file_id"""
+    if isinstance(media, str):
+        return InputMediaDocument(media)
+    # 缓冲区没有可用的 name 属性，不能直接交给 InputMediaDocument
+    return InputMediaDocument(media_input_file(media, filename, attach=True))
+
+def media_digest(buffer):
+    """计算媒体内容的哈希，与文件名一起作为 file_id 缓存的键"""
+    digest = hashlib.blake2b(digest_size=16)
+    buffer.seek(0)
+    for chunk in iter(lambda: buffer.read(1024 * 1024), b''):
+        digest.update(chunk)
+    buffer.seek(0)
+    return digest.hexdigest()
+
+class FileIdCache:
+    """内容哈希:文件名 -> Bot API file_id 的 LRU 缓存，定期以原子替换的方式写入 JSON 文件
+
+    查询结果 bot 经常返回内容完全相同的文件，命中缓存时直接发送 file_id，不再上传文件内容。
+    """
+
+    def __init__(self, file_path, maxsize):
+        self.file_path = file_path
+        self.maxsize = maxsize
+        self._file_ids = OrderedDict()
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._file_ids)
+
+    def load(self):
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                self._file_ids = OrderedDict(json.load(f))
+        except FileNotFoundError:
+            self._file_ids = OrderedDict()
+        except ValueError as e:
+            forward_logger.error("读取 file_id 缓存文件 %s 出错: %s，将重新上传文件", self.file_path, e)
+            self._file_ids = OrderedDict()
+        while len(self._file_ids) > self.maxsize:
+            self._file_ids.popitem(last=False)
+
+    def get(self, key):
+        file_id = self._file_ids.get(key)
+        if file_id is not None:
+            self._file_ids.move_to_end(key)
+        return file_id
+
+    def record(self, file_ids):
+        """记录一次发送中按 file_id 发送（命中）和重新上传（未命中）的文件数量"""
+        hits = sum(1 for file_id in file_ids if file_id)
+        misses = len(file_ids) - hits
+        self.hits += hits
+        self.misses += misses
+        if hits:
+            FILE_ID_CACHE_TOTAL.inc(hits, result='hit')
+        if misses:
+            FILE_ID_CACHE_TOTAL.inc(misses, result='miss')
+
+    def put(self, key, file_id):
+        previous = self._file_ids.get(key)
+        if previous is not None and previous != file_id:
+            # 旧的 file_id 被拒绝后重新上传得到了新的 file_id
+            FILE_ID_CACHE_TOTAL.inc(result='stale')
+        self._file_ids[key] = file_id
+        self._file_ids.move_to_end(key)
+        if len(self._file_ids) > self.maxsize:
+            self._file_ids.popitem(last=False)
+        self._dirty = True
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _write(self, snapshot):
+        write_file_atomic(self.file_path, json.dumps(snapshot).encode('utf-8'))
+
+    async def save(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        snapshot = list(self._file_ids.items())
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._write, dict(snapshot))
+        except Exception as e:
+            self._dirty = True
+            forward_logger.error("写入 file_id 缓存文件出错: %s", e)
+            return
+        forward_logger.info("file_id 缓存已保存，共 %d 条，命中率 %.1f%% (命中 %d / 未命中 %d)",
+                            len(snapshot), self.hit_rate() * 100, self.hits, self.misses)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(FILE_ID_CACHE_SAVE_SECONDS)
+            await self.save()
+
+class SharedMedia:
+    """发送到多个目标群组的同一份媒体缓冲区
+
+    内容哈希只计算一次；读取缓冲区（计算哈希、上传）时持有 lock，同一份媒体只由一个目标上传，
+    其余目标随后直接使用缓存的 file_id。每个目标的发送任务结束后调用 release()，全部结束后关闭缓冲区。
+    """
+
+    def __init__(self, buffer, refs=1, filename=FORWARD_FILENAME):
+        self.buffer = buffer
+        self.refs = refs
+        self.filename = filename
+        self.size = buffer.seek(0, io.SEEK_END)
+        buffer.seek(0)
+        self.digest = None
+        self.lock = asyncio.Lock()
+
+    async def content_digest(self):
+        if self.digest is None:
+            async with self.lock:
+                if self.digest is None:
+                    # 内存中的小文件直接计算，溢出到磁盘的大文件在线程池中计算
+                    if self.size > MEDIA_SPOOL_MAX_BYTES:
+                        loop = asyncio.get_running_loop()
+                        self.digest = await loop.run_in_executor(None, media_digest, self.buffer)
+                    else:
+                        self.digest = media_digest(self.buffer)
+        return self.digest
+
+    async def cache_key(self):
+        """file_id 缓存的键：同一内容以不同文件名发送时分别缓存，命中时文件名不变"""
+        return f"{await self.content_digest()}:{self.filename}"
+
+    def release(self, count=1):
+        self.refs -= count
+        if self.refs <= 0:
+            self.buffer.close()
+
+file_id_cache = FileIdCache(FILE_ID_CACHE_FILE, FILE_ID_CACHE_SIZE)
+metrics.register(Gauge('bybot_file_id_cache_entries', 'file_id 缓存中的条目数量', lambda: len(file_id_cache)))
+
+class TokenBucket:
+    """令牌桶限速，支持按 Telegram 的 retry_after 暂停发送"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate  # 每秒补充的令牌数
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# 待发送到目标群组的消息：文字消息的 payload 为文本，按引用转发时为原消息的元组（媒体组包含多条），文件和媒体组的 payload 为 None；
+# buffers 为待发送的 SharedMedia（带有发送时使用的文件名），发送结束后释放；source_chat 为来源群组
+ForwardJob = namedtuple('ForwardJob', ['kind', 'chat_id', 'payload', 'desc', 'buffers', 'source_chat'],
+                        defaults=(None,))
+
+# 发送名额的优先级：文字消息优先于文件
+FORWARD_PRIORITY = {'text': 0, 'document': 1, 'media_group': 1, 'reference': 1}
+
+def retry_after_seconds(error):
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+class SendSlots:
+    """限制同时进行的发送数量，等待者按 (优先级, 到达顺序) 获得名额"""
+
+    def __init__(self, size):
+        self.free = size
+        self._waiters = []
+        self._seq = 0
+
+    @asynccontextmanager
+    async def hold(self, priority):
+        await self._acquire(priority)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, priority):
+        # 有空闲名额时不会有等待者，名额释放时直接交给等待者
+        if self.free > 0:
+            self.free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 已分配到名额后被取消时归还名额
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.free += 1
+
+class ForwardQueue:
+    """有界转发队列：接收消息与发送解耦，限速发送
+
+    每个 (来源群组, 目标群组) 一条先进先出的通道，由各自的任务按顺序发送，同一来源发往同一目标的消息不会乱序；
+    同时进行的发送不超过 workers 个，文字消息优先获得名额。
+    等待限速、FloodWait 或重试的通道不占用名额，不影响其他目标群组。
+    """
+
+    def __init__(self, maxsize, workers, rate_per_minute, burst, max_retries):
+        self.maxsize = maxsize
+        self.workers = workers
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.max_retries = max_retries
+        self._lanes = {}  # (来源群组, 目标群组) -> 待发送的 ForwardJob
+        self._tasks = {}  # 同上 -> 发送该通道的任务
+        self._buckets = {}
+        self._slots = None
+        self._space = None  # 队列剩余空位
+        self._idle = None
+        self._pending = 0
+
+    def start(self):
+        self._slots = SendSlots(self.workers)
+        self._space = asyncio.Semaphore(self.maxsize)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        forward_logger.info("转发队列已启动，并发发送数量: %d", self.workers)
+
+    def qsize(self):
+        return self._pending
+
+    async def put(self, job):
+        """加入队列，队列满时等待空位"""
+        await self._space.acquire()
+        self._pending += 1
+        self._idle.clear()
+        key = (job.source_chat, job.chat_id)
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = deque()
+        lane.append(job)
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.ensure_future(self._drain(key, lane))
+
+    def _done(self, job):
+        for media in job.buffers:
+            media.release()
+        self._pending -= 1
+        self._space.release()
+        if not self._pending:
+            self._idle.set()
+
+    async def _drain(self, key, lane):
+        """按顺序发送一条通道中的消息，通道清空后退出"""
+        try:
+            while lane:
+                job = lane[0]
+                try:
+                    await self._deliver(job)
+                except Exception as e:
+                    FORWARD_FAILURES_TOTAL.inc(reason='exception')
+                    forward_logger.error("发送消息出错: %s", e, extra=kv(chat_id=job.chat_id, kind=job.kind))
+                finally:
+                    lane.popleft()
+                    self._done(job)
+        finally:
+            del self._tasks[key]
+            if not lane:
+                del self._lanes[key]
+
+    async def close(self, timeout):
+        """等待队列中的消息发送完成后停止发送任务"""
+        if self._idle is None:
+            return
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            forward_logger.error("转发队列在 %s 秒内未能发送完毕，剩余 %d 条消息", timeout, self._pending)
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # 放弃尚未发送的消息，释放其缓冲区
+        for lane in self._lanes.values():
+            for job in lane:
+                self._done(job)
+        self._lanes = {}
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    async def _send(self, job):
+        if job.kind == 'text':
+            with SEND_SECONDS.time(method='send_message'):
+                await bot.send_message(job.chat_id, job.payload)
+        elif job.kind == 'reference':
+            await self._send_reference(job)
+        else:
+            await self._send_media(job)
+
+    async def _send_reference(self, job):
+        """由用户账号复制原消息，媒体组一次转发，媒体按引用发送，不经过本地
+
+        用户账号不在目标群组或没有发言权限时，改为下载后通过机器人发送。
+        """
+        try:
+            with SEND_SECONDS.time(method='send_reference'):
+                await user_client.forward_messages(job.chat_id, list(job.payload), drop_author=True)
+            return
+        except FloodWaitError:
+            raise
+        except (ValueError, RPCError) as e:
+            # 找不到目标群组时 Telethon 抛出 ValueError
+            FORWARD_FAILURES_TOTAL.inc(reason='reference_fallback')
+            forward_logger.warning("用户账号按引用转发失败: %s，改为下载后通过机器人发送", e, extra=kv(chat_id=job.chat_id))
+
+        buffers = []
+        try:
+            for message in job.payload:
+                buffers.append(SharedMedia(await download_media_buffer(message), 1, media_filename(message)))
+            kind = 'document' if len(buffers) == 1 else 'media_group'
+            await self._send_media(job._replace(kind=kind, buffers=tuple(buffers)))
+        finally:
+            for media in buffers:
+                media.release()
+
+    async def _upload(self, job, file_ids):
+        """发送文件或媒体组，file_ids 中有值的文件直接引用已上传的 file_id，返回发送出的消息列表"""
+        if job.kind == 'document':
+            media = job.buffers[0]
+            document = file_ids[0] or media_input_file(media.buffer, media.filename)
+            with SEND_SECONDS.time(method='send_document'):
+                return [await bot.send_document(job.chat_id, document)]
+        media = [media_group_item(file_id or item.buffer, item.filename) for item, file_id in zip(job.buffers, file_ids)]
+        with SEND_SECONDS.time(method='send_media_group'):
+            return await bot.send_media_group(job.chat_id, media)
+
+    async def _send_media(self, job):
+        keys = [await media.cache_key() for media in job.buffers]
+        file_ids = [file_id_cache.get(key) for key in keys]
+        rejected = False
+        if all(file_ids):
+            # 全部命中缓存时不读取缓冲区，各目标并发发送
+            try:
+                await self._upload(job, file_ids)
+                file_id_cache.record(file_ids)
+                return
+            except BadRequest as e:
+                # file_id 可能已失效（例如机器人令牌更换），重新上传；上传成功后替换缓存
+                forward_logger.warning("按 file_id 发送被拒绝: %s，重新上传文件", e, extra=kv(chat_id=job.chat_id))
+                rejected = True
+
+        # 需要上传时持有媒体的锁，等待期间其他目标可能已经上传了同一份媒体
+        async with AsyncExitStack() as stack:
+            for media in job.buffers:
+                await stack.enter_async_context(media.lock)
+            if rejected:
+                file_ids = [None] * len(keys)
+            else:
+                file_ids = [file_id_cache.get(key) for key in keys]
+            try:
+                messages = await self._upload(job, file_ids)
+            except BadRequest as e:
+                if not any(file_ids):
+                    raise
+                forward_logger.warning("按 file_id 发送被拒绝: %s，重新上传文件", e, extra=kv(chat_id=job.chat_id))
+                file_ids = [None] * len(keys)
+                messages = await self._upload(job, file_ids)
+
+            for key, file_id, message in zip(keys, file_ids, messages):
+                document = getattr(message, 'document', None)
+                if file_id is None and document is not None:
+                    file_id_cache.put(key, document.file_id)
+        file_id_cache.record(file_ids)
+
+    async def _deliver(self, job):
+        bucket = self._bucket(job.chat_id)
+        priority = FORWARD_PRIORITY[job.kind]
+        for attempt in range(1, self.max_retries + 1):
+            # 先等待限速，再占用发送名额
+            await bucket.acquire()
+            delay = 0
+            async with self._slots.hold(priority):
+                try:
+                    await self._send(job)
+                    forward_logger.info(job.desc, extra=kv(chat_id=job.chat_id, kind=job.kind))
+                    return
+                except RetryAfter as e:
+                    # 触发 FloodWait，暂停该目标的所有发送
+                    wait = retry_after_seconds(e)
+                    bucket.pause(wait)
+                    FORWARD_FAILURES_TOTAL.inc(reason='retry_after')
+                    forward_logger.warning("发送到 %s 触发限流，%s 秒后重试 (%d/%d)", job.chat_id, wait, attempt, self.max_retries)
+                except FloodWaitError as e:
+                    # 用户账号按引用转发时触发的 FloodWait
+                    bucket.pause(e.seconds)
+                    FORWARD_FAILURES_TOTAL.inc(reason='retry_after')
+                    forward_logger.warning("发送到 %s 触发限流，%s 秒后重试 (%d/%d)", job.chat_id, e.seconds, attempt, self.max_retries)
+                except RPCError as e:
+                    FORWARD_FAILURES_TOTAL.inc(reason='rpc_error')
+                    forward_logger.error("用户账号转发到 %s 出错: %s", job.chat_id, e)
+                    return
+                except BadRequest as e:
+                    FORWARD_FAILURES_TOTAL.inc(reason='bad_request')
+                    forward_logger.error("发送到 %s 的请求被拒绝: %s", job.chat_id, e)
+                    return
+                except NetworkError as e:
+                    delay = min(60, 2 ** attempt)
+                    FORWARD_FAILURES_TOTAL.inc(reason='network')
+                    forward_logger.warning("发送到 %s 出现网络错误: %s，%s 秒后重试 (%d/%d)",
+                                           job.chat_id, e, delay, attempt, self.max_retries)
+                except TelegramError as e:
+                    FORWARD_FAILURES_TOTAL.inc(reason='telegram_error')
+                    forward_logger.error("发送到 %s 出错: %s", job.chat_id, e)
+                    return
+            # 退避期间不占用发送名额
+            if delay:
+                await asyncio.sleep(delay)
+        FORWARD_FAILURES_TOTAL.inc(reason='retries_exhausted')
+        forward_logger.error("发送到 %s 的消息重试 %d 次后仍失败，已放弃", job.chat_id, self.max_retries)
+
+forward_queue = ForwardQueue(FORWARD_QUEUE_SIZE, FORWARD_WORKERS, FORWARD_RATE_PER_MINUTE,
+                             FORWARD_BURST, FORWARD_MAX_RETRIES)
+metrics.register(Gauge('bybot_forward_queue_size', '转发队列中等待发送的消息数量', lambda: forward_queue.qsize()))
+
+class PendingBatch:
+    """聚合窗口内同一来源尚未发送的消息"""
+
+    def __init__(self, kind, chat_id, desc, grouped_id=None):
+        self.kind = kind  # 'text'、'media_group' 或 'reference'
+        self.chat_id = chat_id
+        self.desc = desc
+        self.grouped_id = grouped_id
+        self.items = []
+        self.length = 0
+        self.timer = None
+
+class DeliveryAggregator:
+    """在短时间窗口内合并同一来源的消息后再交给转发队列
+
+    连续的文字消息合并为一条（不超过 Telegram 的长度限制），
+    grouped_id 相同的文件合并为一次 send_media_group，按引用转发的媒体组合并为一次转发；
+    同一来源出现不同类型的消息时先发送已聚合的内容，转发队列再按 (来源, 目标) 先进先出发送，保证顺序不变。
+    """
+
+    def __init__(self, queue, window, text_limit=TELEGRAM_TEXT_LIMIT, media_group_limit=TELEGRAM_MEDIA_GROUP_LIMIT):
+        self.queue = queue
+        self.window = window
+        self.text_limit = text_limit
+        self.media_group_limit = media_group_limit
+        self._batches = {}  # (来源群组, 目标群组) -> PendingBatch
+
+    def _schedule(self, key, batch):
+        loop = asyncio.get_running_loop()
+        batch.timer = loop.call_later(self.window, lambda: asyncio.ensure_future(self._flush(key, batch)))
+
+    async def _flush(self, key, batch=None):
+        """发送 key 当前的聚合内容；传入 batch 时只在它仍是当前聚合时发送"""
+        current = self._batches.get(key)
+        if current is None or (batch is not None and current is not batch):
+            return
+        del self._batches[key]
+        if current.timer is not None:
+            current.timer.cancel()
+
+        if len(current.items) > 1:
+            COALESCED_MESSAGES_TOTAL.inc(len(current.items) - 1, kind=current.kind)
+        if current.kind == 'text':
+            text = TEXT_JOIN_SEPARATOR.join(current.items)
+            await self.queue.put(ForwardJob('text', current.chat_id, text, current.desc, (), key[0]))
+        else:
+            await self.queue.put(self._media_job(current.kind, current.chat_id, current.items, current.desc, key[0]))
+
+    @staticmethod
+    def _media_job(kind, chat_id, items, desc, source_chat):
+        """由文件缓冲区或按引用转发的消息构造发送任务"""
+        if kind == 'reference':
+            return ForwardJob('reference', chat_id, tuple(items), desc, (), source_chat)
+        buffers = tuple(items)
+        kind = 'document' if len(buffers) == 1 else 'media_group'
+        return ForwardJob(kind, chat_id, None, desc, buffers, source_chat)
+
+    async def add_text(self, source_chat, chat_id, text, desc):
+        key = (source_chat, chat_id)
+        batch = self._batches.get(key)
+        if batch is not None and (batch.kind != 'text'
+                                  or batch.length + len(TEXT_JOIN_SEPARATOR) + len(text) > self.text_limit):
+            await self._flush(key)
+            batch = None
+
+        if batch is None:
+            batch = self._batches[key] = PendingBatch('text', chat_id, desc)
+            self._schedule(key, batch)
+        elif batch.items:
+            batch.length += len(TEXT_JOIN_SEPARATOR)
+        batch.items.append(text)
+        batch.length += len(text)
+
+    async def _add_media(self, kind, source_chat, chat_id, item, desc, grouped_id):
+        key = (source_chat, chat_id)
+        batch = self._batches.get(key)
+        if batch is not None and (batch.kind != kind or grouped_id is None
+                                  or batch.grouped_id != grouped_id
+                                  or len(batch.items) >= self.media_group_limit):
+            await self._flush(key)
+            batch = None
+
+        if grouped_id is None:
+            # 不属于媒体组的文件直接发送
+            await self.queue.put(self._media_job(kind, chat_id, (item,), desc, source_chat))
+            return
+
+        if batch is None:
+            batch = self._batches[key] = PendingBatch(kind, chat_id, desc, grouped_id)
+            self._schedule(key, batch)
+        batch.items.append(item)
+
+    async def add_document(self, source_chat, chat_id, media, desc, grouped_id=None):
+        await self._add_media('media_group', source_chat, chat_id, media, desc, grouped_id)
+
+    async def add_reference(self, source_chat, chat_id, message, desc, grouped_id=None):
+        """按引用转发的媒体，grouped_id 相同的消息合并为一次转发"""
+        await self._add_media('reference', source_chat, chat_id, message, desc, grouped_id)
+
+    async def close(self):
+        """发送所有尚未发送的聚合内容"""
+        for key in list(self._batches):
+            await self._flush(key)
+
+aggregator = DeliveryAggregator(forward_queue, AGGREGATE_WINDOW_SECONDS)
+
+class DuplicateWindow:
+    """最近处理过的消息内容的去重窗口
+
+    记录按插入顺序保存，过期时间相同，因此最早的记录总是最先过期；
+    超过容量或过期的记录从头部淘汰。窗口内再次出现的内容不会延长过期时间。
+    """
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._seen = OrderedDict()  # 去重键 -> 过期时间
+
+    def __len__(self):
+        return len(self._seen)
+
+    def seen(self, key):
+        """key 在窗口内出现过时返回 True，否则记录 key 并返回 False"""
+        if self.ttl <= 0:
+            return False
+        now = time.monotonic()
+        expires_at = self._seen.get(key)
+        if expires_at is not None and expires_at > now:
+            return True
+        self._seen[key] = now + self.ttl
+        self._seen.move_to_end(key)
+        while self._seen:
+            oldest, expires_at = next(iter(self._seen.items()))
+            if expires_at > now and len(self._seen) <= self.maxsize:
+                break
+            self._seen.popitem(last=False)
+        return False
+
+duplicate_window = DuplicateWindow(DUPLICATE_WINDOW_SECONDS, DUPLICATE_WINDOW_SIZE)
+metrics.register(Gauge('bybot_duplicate_window_entries', '去重窗口中的记录数量', lambda: len(duplicate_window)))
+
+def normalize_text(text):
+    """去掉首尾空白并合并连续空白，格式上的细微差别不影响去重"""
+    return ' '.join(text.split()) if text else ''
+
+def content_key(targets, *parts):
+    """由目标群组和消息内容计算去重键，parts 为字符串或字节串"""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return tuple(targets), digest.digest()
+
+def media_identity(message):
+    """媒体在 Telegram 中的文件或照片 ID，只读取元数据"""
+    for attr in ('document', 'photo'):
+        media_id = getattr(getattr(message, attr, None), 'id', None)
+        if media_id is not None:
+            return f"{attr}:{media_id}"
+    return None
+
+def is_duplicate(key, kind):
+    """key 在去重窗口内出现过时计数并返回 True"""
+    if duplicate_window.seen(key):
+        DUPLICATES_SUPPRESSED_TOTAL.inc(kind=kind)
+        return True
+    return False
+
+def is_duplicate_message(message, targets, kind):
+    """按规范化后的文字或媒体 ID（连同说明）判断消息是否重复，不下载任何内容"""
+    if kind == 'text':
+        return is_duplicate(content_key(targets, 'text', normalize_text(message.text)), 'text')
+    identity = media_identity(message)
+    if identity is None:
+        return False
+    return is_duplicate(content_key(targets, 'media', identity, normalize_text(message.text)), 'media')
+
+async def forward_text(source_chat, targets, message_text, desc):
+    for chat_id in targets:
+        await aggregator.add_text(source_chat, chat_id, message_text, desc)
+
+async def forward_media(message, targets, kind, sender_desc=""):
+    """按 classify_media 的结果处理媒体
+
+    需要解析的文本文件下载一次、解析一次，同一份缓冲区既用于提取链接，也用于发送到所有目标群组；
+    其他媒体开启 MEDIA_FORWARD_BY_REFERENCE 时按引用转发，不下载到本地，否则下载后通过机器人发送。
+    """
+    if kind == 'skip':
+        MEDIA_FILTER_TOTAL.inc(decision='skip')
+        ingest_logger.info("媒体超过大小上限，跳过转发", extra=kv(chat_id=message.chat_id, size=message.file.size))
+        return
+    if kind == 'forward' and MEDIA_FORWARD_BY_REFERENCE:
+        MEDIA_FILTER_TOTAL.inc(decision='reference')
+        desc = f"{sender_desc}媒体消息已按引用转发到目标群组"
+        for chat_id in targets:
+            await aggregator.add_reference(message.chat_id, chat_id, message, desc, message.grouped_id)
+        return
+
+    MEDIA_FILTER_TOTAL.inc(decision='parse' if kind == 'parse' else 'download')
+    buffer = await download_media_buffer(message)
+    # 只有解析过的查询结果使用统一的文件名
+    media = SharedMedia(buffer, len(targets), FORWARD_FILENAME if kind == 'parse' else media_filename(message))
+    handed_off = 0
+    try:
+        # 重新上传的相同文件 ID 不同，下载后再按内容哈希去重；哈希会缓存，发送时不再重复计算
+        key = content_key(targets, 'content', await media.content_digest(), normalize_text(message.text))
+        if is_duplicate(key, 'media'):
+            return
+
+        # 提取文本文件内容并筛选链接；文件可能有数十 MB，在线程池中解析，不阻塞事件循环
+        if kind == 'parse':
+            loop = asyncio.get_running_loop()
+            entries = await loop.run_in_executor(None, extract_entries, buffer)
+            if entries:
+                save_links(entries, message.chat_id)
+            else:
+                parse_logger.info("未找到符合条件的链接")
+
+        # 通过机器人发送文件并指定文件名，缓冲区在所有目标发送结束后关闭
+        desc = f"{sender_desc}文件消息已通过机器人发送到目标群组"
+        for chat_id in targets:
+            await aggregator.add_document(message.chat_id, chat_id, media, desc, message.grouped_id)
+            handed_off += 1
+    finally:
+        # 未交给转发队列的目标不会再释放缓冲区
+        media.release(len(targets) - handed_off)
+
+class Route:
+    """单个来源群组的路由策略：转发所有消息，或只处理指定 bot 的消息；targets 为目标群组列表"""
+
+    def __init__(self, chat_id, targets, bot_usernames=None):
+        self.chat_id = chat_id
+        self.targets = targets
+        self.forward_all = bot_usernames is None
+        self.bot_usernames = set(bot_usernames or ())
+        self.bot_ids = set()  # 已解析出用户 ID 的 bot
+        self.unresolved = set(self.bot_usernames)  # 尚未解析出用户 ID 的 bot 用户名
+
+    def add_bot(self, username, user_id):
+        self.bot_ids.add(user_id)
+        self.unresolved.discard(username)
+
+def normalize_username(username):
+    return username.lstrip('@').lower() if username else None
+
+def build_routes(source_chat_ids, monitoring_chats, default_targets, source_targets):
+    """根据配置编译路由表：整数 chat_id -> Route"""
+    routes = {}
+    for chat_id in source_chat_ids:
+        routes[chat_id] = Route(chat_id, source_targets.get(chat_id, default_targets))
+    for chat_id, usernames in monitoring_chats.items():
+        chat_id = int(chat_id)
+        routes[chat_id] = Route(chat_id, source_targets.get(chat_id, default_targets),
+                                [normalize_username(name) for name in usernames])
+    return routes
+
+ROUTES = build_routes(SOURCE_CHAT_IDS, MONITORING_CHATS, TARGET_CHAT_IDS, SOURCE_TARGETS)
+
+class SenderCache:
+    """sender_id -> 用户名 的 LRU 缓存，只在需要按用户名匹配时才请求发送者信息"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+
+    async def username(self, event):
+        sender_id = event.sender_id
+        if sender_id in self._cache:
+            self._cache.move_to_end(sender_id)
+            return self._cache[sender_id]
+
+        sender = await event.get_sender()
+        username = normalize_username(getattr(sender, 'username', None))
+        self._cache[sender_id] = username
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return username
+
+sender_cache = SenderCache(SENDER_CACHE_SIZE)
+
+async def resolve_routes():
+    """启动时将路由表中的 bot 用户名解析为用户 ID，之后按 sender_id 直接匹配"""
+    resolved = {}
+    for route in ROUTES.values():
+        for username in list(route.unresolved):
+            if username not in resolved:
+                try:
+                    entity = await user_client.get_entity(username)
+                    resolved[username] = entity.id
+                except Exception as e:
+                    resolved[username] = None
+                    ingest_logger.warning("无法解析 bot 用户名 %s: %s，将在收到消息时按用户名匹配", username, e)
+            if resolved[username] is not None:
+                route.add_bot(username, resolved[username])
+    ingest_logger.info("路由表已编译，来源群组数量: %d，已解析 bot 数量: %d",
+                       len(ROUTES), sum(1 for v in resolved.values() if v is not None))
+
+async def is_monitored_sender(route, event):
+    """判断消息是否来自路由中指定的 bot"""
+    if event.sender_id in route.bot_ids:
+        return True
+    if not route.unresolved:
+        return False
+
+    # 仍有未解析的 bot 时，按用户名匹配并记住其 ID
+    username = await sender_cache.username(event)
+    if username in route.unresolved:
+        route.add_bot(username, event.sender_id)
+        return True
+    return False
+
+async def handler(event):
+    # 补抓期间该群组的实时消息先暂存，补抓完成后再按顺序处理
+    if catch_up.defer(event):
+        return
+    with HANDLER_SECONDS.time():
+        await handle_message(event)
+    checkpoints.advance(event.chat_id, event.message.id)
+
+def parse_text(text, source_chat, what="文字消息"):
+    """文字消息或媒体说明中包含关键词时提取链接"""
+    if not text or not PARSE_KEYWORDS_PATTERN.search(text):
+        ingest_logger.debug("%s不符合预定格式，跳过处理", what)
+        return
+    ingest_logger.debug("捕获到符合预定格式的%s", what)
+    entries = extract_entries(text)
+    if entries:
+        save_links(entries, source_chat)
+    else:
+        parse_logger.info("%s未找到符合条件的链接", what)
+
+async def handle_message(event):
+    # 获取消息文本和文件
+    message_text = event.message.text
+    media = event.message.media
+    # 只根据元数据预筛选媒体，网页预览按文字消息处理
+    kind = classify_media(event.message) if media else 'text'
+
+    # 根据路由表判断消息的处理方式
+    chat_id = event.chat_id
+    route = ROUTES.get(chat_id)
+    if route is None:
+        return
+
+    # 记录消息内容
+    ingest_logger.info("捕获到新消息", extra=kv(chat_id=chat_id, sender_id=event.sender_id,
+                                              media=bool(media), text=Payload(message_text)))
+
+    # 如果是需要监控 bot 的特定群组
+    if not route.forward_all:
+        if await is_monitored_sender(route, event):
+            ingest_logger.debug("消息来自指定的 bot", extra=kv(chat_id=chat_id, sender_id=event.sender_id))
+            if is_duplicate_message(event.message, route.targets, kind):
+                ingest_logger.debug("重复消息，跳过处理", extra=kv(chat_id=chat_id, sender_id=event.sender_id))
+                return
+            try:
+                if kind != 'text':
+                    # 媒体说明中也可能包含查询结果
+                    if message_text:
+                        parse_text(message_text, chat_id, "媒体说明")
+                    await forward_media(event.message, route.targets, kind, "指定 bot 的")
+                else:
+                    # 处理文字消息，检查是否符合预定格式
+                    parse_text(message_text, chat_id)
+
+                    # 转发文字消息到目标群组
+                    await forward_text(chat_id, route.targets, message_text, "指定 bot 的文字消息已通过机器人发送到目标群组")
+            except Exception as e:
+                ingest_logger.error("处理指定 bot 的消息出错: %s", e, extra=kv(chat_id=chat_id))
+        else:
+            ingest_logger.debug("消息不是来自指定的 bot 列表，跳过复制", extra=kv(chat_id=chat_id, sender_id=event.sender_id))
+    # 如果是其他监控的群组，则正常转发所有消息
+    else:
+        if is_duplicate_message(event.message, route.targets, kind):
+            ingest_logger.debug("重复消息，跳过处理", extra=kv(chat_id=chat_id, sender_id=event.sender_id))
+            return
+        try:
+            if kind != 'text':
+                await forward_media(event.message, route.targets, kind)
+            else:
+                await forward_text(chat_id, route.targets, message_text, "消息已通过机器人发送到目标群组")
+        except Exception as e:
+            ingest_logger.error("处理消息出错: %s", e, extra=kv(chat_id=chat_id))
+
+class Checkpoints:
+    """每个来源群组最后处理的消息 ID，定期以原子替换的方式写入 JSON 文件"""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._last_ids = {}
+        self._dirty = False
+
+    def get(self, chat_id):
+        return self._last_ids.get(chat_id)
+
+    def load(self):
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                self._last_ids = {int(chat_id): int(message_id) for chat_id, message_id in json.load(f).items()}
+        except FileNotFoundError:
+            self._last_ids = {}
+        except (ValueError, AttributeError) as e:
+            ingest_logger.error("读取检查点文件 %s 出错: %s，将不补抓消息", self.file_path, e)
+            self._last_ids = {}
+
+    def advance(self, chat_id, message_id):
+        if message_id > self._last_ids.get(chat_id, 0):
+            self._last_ids[chat_id] = message_id
+            self._dirty = True
+
+    def _write(self, snapshot):
+        write_file_atomic(self.file_path, json.dumps(snapshot).encode('utf-8'))
+
+    async def save(self):
+        """先提交链接存储，再写入检查点，避免检查点越过尚未落盘的链接
+
+        worker 进程中等待协调进程确认已写入发送过去的条目，未确认时不写入检查点。
+        """
+        if not self._dirty:
+            return
+        if worker_links is not None:
+            if not await worker_links.flush(LINK_ACK_TIMEOUT_SECONDS):
+                ingest_logger.warning("协调进程尚未确认链接已写入，暂不保存检查点")
+                return
+        else:
+            await link_store.flush()
+        self._dirty = False
+        snapshot = {str(chat_id): message_id for chat_id, message_id in self._last_ids.items()}
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._write, snapshot)
+        except Exception as e:
+            self._dirty = True
+            ingest_logger.error("写入检查点文件出错: %s", e)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(CHECKPOINT_INTERVAL_SECONDS)
+            await self.save()
+
+checkpoints = Checkpoints(CHECKPOINT_FILE)
+
+class CatchUp:
+    """重启后补抓停机期间的消息
+
+    每个群组拉取检查点之后最新的 max_messages 条消息（每次请求最多 100 条），按时间顺序处理，多个群组并发补抓；
+    补抓到的消息与实时消息走同一个 handle_message，每批处理完后统一提交链接并推进检查点。
+    补抓期间到达的实时消息先暂存，补抓完成后跳过已处理的消息 ID 再依次处理，因此不会重复。
+    """
+
+    def __init__(self, max_messages, concurrency, batch_size):
+        self.max_messages = max_messages
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self._deferred = {}  # chat_id -> 补抓期间暂存的实时事件
+
+    def begin(self, chat_ids):
+        """在客户端开始接收更新之前调用，之后这些群组的实时消息会被暂存"""
+        if self.max_messages:
+            for chat_id in chat_ids:
+                self._deferred.setdefault(chat_id, [])
+
+    def defer(self, event):
+        deferred = self._deferred.get(event.chat_id)
+        if deferred is None:
+            return False
+        deferred.append(event)
+        return True
+
+    async def _handle_batch(self, chat_id, messages):
+        for message in messages:
+            with HANDLER_SECONDS.time():
+                await handle_message(events.NewMessage.Event(message))
+        BACKFILL_MESSAGES_TOTAL.inc(len(messages))
+        checkpoints.advance(chat_id, messages[-1].id)
+        await checkpoints.save()
+
+    async def _backfill_chat(self, chat_id):
+        last_id = checkpoints.get(chat_id)
+        if last_id is None:
+            # 首次运行没有检查点，从当前最新消息开始，不补抓历史消息
+            latest = await user_client.get_messages(chat_id, limit=1)
+            if latest:
+                checkpoints.advance(chat_id, latest[0].id)
+            return 0
+
+        # 从最新的消息往前拉取，多拉一条用于判断是否超过上限；超过时跳过的是最早的消息
+        messages = [message async for message in user_client.iter_messages(
+            chat_id, min_id=last_id, limit=self.max_messages + 1, wait_time=0)]
+        if len(messages) > self.max_messages:
+            del messages[self.max_messages:]
+            ingest_logger.warning("停机期间的消息超过补抓上限 %d，只处理最新的 %d 条，更早的消息已跳过",
+                                  self.max_messages, self.max_messages, extra=kv(chat_id=chat_id))
+        messages.reverse()
+        for start in range(0, len(messages), self.batch_size):
+            await self._handle_batch(chat_id, messages[start:start + self.batch_size])
+        return len(messages)
+
+    async def _finish_chat(self, chat_id):
+        """处理补抓期间暂存的实时消息，直到暂存队列为空后恢复实时处理"""
+        deferred = self._deferred[chat_id]
+        while deferred:
+            deferred.sort(key=lambda event: event.message.id)
+            event = deferred.pop(0)
+            last_id = checkpoints.get(chat_id)
+            if last_id is not None and event.message.id <= last_id:
+                continue  # 已在补抓中处理过
+            with HANDLER_SECONDS.time():
+                await handle_message(event)
+            checkpoints.advance(chat_id, event.message.id)
+        del self._deferred[chat_id]
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+
+        async def catch_up_chat(chat_id):
+            async with semaphore:
+                try:
+                    return await self._backfill_chat(chat_id)
+                except Exception as e:
+                    ingest_logger.error("补抓消息出错: %s", e, extra=kv(chat_id=chat_id))
+                    return 0
+                finally:
+                    await self._finish_chat(chat_id)
+
+        counts = await asyncio.gather(*(catch_up_chat(chat_id) for chat_id in list(self._deferred)))
+        await checkpoints.save()
+        if counts:
+            ingest_logger.info("补抓完成，共处理 %d 条消息，耗时 %.1f 秒", sum(counts), loop.time() - started)
+
+catch_up = CatchUp(BACKFILL_MAX_MESSAGES, BACKFILL_CONCURRENCY, BACKFILL_BATCH_SIZE)
+
+def create_clients(session_file=SESSION_FILE, chat_ids=SOURCE_CHAT_IDS):
+    """创建 Telegram 客户端和机器人客户端，并注册消息处理器"""
+    global user_client, bot
+    user_client = TelegramClient(session_file, API_ID, API_HASH)
+    user_client.add_event_handler(handler, events.NewMessage(chats=chat_ids))
+    bot = Bot(BOT_TOKEN)
+
+async def main():
+    forward_queue.start()
+    # 只补抓注册了消息处理器的群组；MONITORING_CHATS 中不在 SOURCE_CHAT_IDS 里的群组收不到实时消息，也不补抓
+    listened = [chat_id for chat_id in ROUTES if chat_id in SOURCE_CHAT_IDS]
+    ignored = [chat_id for chat_id in ROUTES if chat_id not in SOURCE_CHAT_IDS]
+    if ignored:
+        ingest_logger.warning("MONITORING_CHATS 中的群组不在 SOURCE_CHAT_IDS 中，不会处理其消息: %s", ignored)
+    catch_up.begin(listened)
+    await user_client.start()
+    await resolve_routes()
+    logger.info("监控已启动")
+    try:
+        await catch_up.run()
+        await user_client.run_until_disconnected()
+    finally:
+        # 退出前发送聚合中和队列中剩余的消息
+        await aggregator.close()
+        await forward_queue.close(FORWARD_DRAIN_TIMEOUT)
+        # 退出前提交尚未写入的链接，然后保存检查点
+        await link_store.flush()
+        await checkpoints.save()
+        await file_id_cache.save()
+
+def calculate_md5(file_path):
+    """计算文件的 MD5 值"""
+    md5_hash = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(4096), b""):
+            md5_hash.update(chunk)
+    return md5_hash.hexdigest()
+
+def load_dymb(path):
+    """以模块方式加载 dymb.py，在进程内调用其渲染接口"""
+    spec = importlib.util.spec_from_file_location('dymb', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+dymb = load_dymb(DYNB_PY_PATH)
+
+def build_subscriptions(links):
+    """节点已合并到本地节点文件中的订阅改为引用该文件，其余订阅仍使用远程地址"""
+    merged_links = subscription_cache.merged_links
+    subscriptions = dymb.build_subscriptions([link for link in links if link not in merged_links])
+    if any(link in merged_links for link in links):
+        shards = subscription_cache.shards
+        subscriptions[:0] = [
+            {'name': MERGED_PROVIDER_NAME if shards == 1 else f"{MERGED_PROVIDER_NAME}_{index + 1}",
+             'path': shard_path(SUBSCRIPTION_MERGED_PROVIDER_PATH, index, shards)}
+            for index in subscription_cache.merged_shards
+        ]
+    return subscriptions
+
+def regenerate_config():
+    """订阅内容缓存更新后重新生成配置文件（在线程池中调用）"""
+    with FileLock(f"{DYDZ_TXT_PATH}.lock"):
+        update_subscriptions()
+
+def update_subscriptions():
+    """根据 dydz.txt 中的订阅地址重新生成配置文件（在线程池中调用）"""
+    try:
+        # 读取 dydz.txt 文件中的订阅地址
+        with RENDER_SECONDS.time():
+            links = dymb.read_links(DYDZ_TXT_PATH)
+            written = dymb.write_config(build_subscriptions(links), ZYDY_YAML_PATH)
+        if written:
+            render_logger.info("配置文件已重新生成: %s，订阅数量: %d", ZYDY_YAML_PATH, len(links))
+        else:
+            render_logger.info("配置文件内容未变化，跳过写入")
+    except Exception as e:
+        render_logger.error("生成配置文件时出错: %s", e)
+
+class DydzEventHandler(FileSystemEventHandler):
+    """只关注 dydz.txt 本身的文件系统事件，在事件循环中触发回调"""
+
+    def __init__(self, file_path, loop, callback):
+        super().__init__()
+        self.file_path = os.path.abspath(file_path)
+        self.loop = loop
+        self.callback = callback
+
+    def on_any_event(self, event):
+        paths = (event.src_path, getattr(event, 'dest_path', None))
+        if any(path and os.path.abspath(path) == self.file_path for path in paths):
+            self.loop.call_soon_threadsafe(self.callback)
+
+def start_observer(file_path, event_handler):
+    """启动文件监听，inotify 不可用时退回轮询"""
+    watch_dir = os.path.dirname(os.path.abspath(file_path))
+    observer = Observer()
+    try:
+        observer.schedule(event_handler, watch_dir, recursive=False)
+        observer.start()
+    except OSError as e:
+        watcher_logger.warning("无法启动文件事件监听: %s，改用轮询方式", e)
+        observer = PollingObserver(timeout=WATCH_MAX_LATENCY_SECONDS)
+        observer.schedule(event_handler, watch_dir, recursive=False)
+        observer.start()
+    return observer
+
+def file_fingerprint(file_path):
+    """廉价的文件指纹：修改时间、大小和 inode，文件不存在时返回 None"""
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+def check_dydzt(lock, last_fingerprint, last_md5):
+    """在线程池中执行：指纹变化时才计算 MD5，MD5 变化时更新订阅配置"""
+    with lock:  # 使用文件锁避免并发问题
+        fingerprint = file_fingerprint(DYDZ_TXT_PATH)
+        if fingerprint == last_fingerprint:
+            return fingerprint, last_md5
+
+        current_md5 = calculate_md5(DYDZ_TXT_PATH)
+        if last_md5 != current_md5:
+            watcher_logger.info("检测到 dydz.txt 文件内容发生变化，MD5 值: %s", current_md5)
+            update_subscriptions()
+        return fingerprint, current_md5
+
+async def monitor_dydzt():
+    """监听 dydz.txt 的文件事件，合并短时间内的多次变化后再检查 MD5"""
+    loop = asyncio.get_running_loop()
+    lock = FileLock(f"{DYDZ_TXT_PATH}.lock")
+    changed = asyncio.Event()
+    changed.set()  # 启动时先检查一次
+    observer = start_observer(DYDZ_TXT_PATH, DydzEventHandler(DYDZ_TXT_PATH, loop, changed.set))
+    last_fingerprint = None
+    last_md5 = None
+
+    try:
+        while True:
+            await changed.wait()
+
+            # 防抖：安静 WATCH_DEBOUNCE_SECONDS 后再处理，但从首次变化起最多等待 WATCH_MAX_LATENCY_SECONDS
+            deadline = loop.time() + WATCH_MAX_LATENCY_SECONDS
+            while True:
+                changed.clear()
+                timeout = min(WATCH_DEBOUNCE_SECONDS, deadline - loop.time())
+                if timeout <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            changed.clear()
+            WATCHER_TRIGGERS_TOTAL.inc()
+
+            try:
+                previous_md5 = last_md5
+                last_fingerprint, last_md5 = await loop.run_in_executor(
+                    None, check_dydzt, lock, last_fingerprint, last_md5)
+                if last_md5 != previous_md5:
+                    subscription_cache.request_refresh()
+            except Exception as e:
+                watcher_logger.error("监控 dydz.txt 文件时出错: %s", e)
+    finally:
+        observer.stop()
+        await loop.run_in_executor(None, observer.join)
+
+def save_initial_md5():
+    """保存 dydz.txt 的初始 MD5"""
+    try:
+        with FileLock(f"{MD5_FILE_PATH}.lock"):
+            current_md5 = calculate_md5(DYDZ_TXT_PATH)
+            with open(MD5_FILE_PATH, 'w', encoding='utf-8') as f:
+                f.write(current_md5)
+    except Exception as e:
+        watcher_logger.error("保存初始 MD5 时出错: %s", e)
+
+def prepare_link_files():
+    # 加载已有链接并去除文件中的重复链接
+    link_store.load()
+
+    # 确保目标文件存在
+    if not os.path.exists(DYDZ_TXT_PATH):
         with open(DYDZ_TXT_PATH, 'w', encoding='utf-8') as f:
             pass
-    
+
+async def run_with_background(main_coro, *background):
+    """运行 main_coro，同时在后台运行各循环任务；main_coro 结束后取消后台任务，使进程能够退出"""
+    tasks = [asyncio.ensure_future(coro) for coro in background]
+    try:
+        return await main_coro
+    finally:
+        for task in tasks:
+            task.cancel()
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error("后台任务异常退出: %s", result)
+
+def install_stop_handler(loop, stop):
+    """收到 SIGTERM/SIGINT 时调用 stop；在容器中作为 PID 1 运行时，Python 默认不会响应 SIGTERM"""
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop)
+
+def run_single():
+    """单进程模式：一个会话接收所有来源群组的消息"""
+    prepare_link_files()
+    checkpoints.load()
+    file_id_cache.load()
+
     # 启动 Telegram 客户端
+    create_clients()
     with user_client:
-        # 保存MD5到文件
-        try:
-            with FileLock(f"{MD5_FILE_PATH}.lock"):
-                current_md5 = calculate_md5(DYDZ_TXT_PATH)
-                with open(MD5_FILE_PATH, 'w', encoding='utf-8') as f:
-                    f.write(current_md5)
-        except Exception as e:
-            logger.error(f"保存初始 MD5 时出错: {e}")
-        
-        # 启动监控任务和主循环
+        save_initial_md5()
+
+        # 启动监控任务和主循环；收到停止信号时断开连接，main() 退出前会发送完队列中的消息
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(asyncio.gather(
+        install_stop_handler(loop, lambda: asyncio.ensure_future(user_client.disconnect()))
+        loop.run_until_complete(run_with_background(
             main(),
+            link_store.run(),
+            checkpoints.run(),
+            file_id_cache.run(),
+            run_evictor(),
+            run_metrics_server(),
+            run_prober(),
+            run_subscription_cache(),
             monitor_dydzt()
-        ))
\ No newline at end of file
+        ))
+
+def shard_chats(chat_ids, count):
+    """按 chat_id 的哈希分片，增删群组不会改变其他群组所在的分片"""
+    shards = [[] for _ in range(count)]
+    for chat_id in chat_ids:
+        shards[shard_index(chat_id, count)].append(chat_id)
+    return shards
+
+def run_worker(index, session_file, chat_ids, ingest_queue, ack_queue):
+    """worker 进程：用独立的会话接收分片内群组的消息，下载、解析并转发，解析出的条目交给协调进程"""
+    global ROUTES, worker_links
+    ROUTES = {chat_id: route for chat_id, route in ROUTES.items() if chat_id in chat_ids}
+    worker_links = WorkerLinks(ingest_queue, ack_queue)
+
+    # 检查点和 file_id 缓存按会话区分，避免多个进程写同一个文件
+    checkpoints.file_path = f"{session_file}.checkpoint.json"
+    file_id_cache.file_path = f"{session_file}.file_ids.json"
+    checkpoints.load()
+    file_id_cache.load()
+
+    # 所有 worker 共用同一个机器人，发送速率由各 worker 平均分摊
+    forward_queue.rate /= len(WORKER_SESSIONS)
+
+    create_clients(session_file, chat_ids)
+    with user_client:
+        loop = asyncio.get_event_loop()
+        # 协调进程停止 worker 时断开连接，main() 退出前会发送完队列中的消息；
+        # 连接意外断开时 main() 同样会返回，进程退出后由协调进程重启
+        install_stop_handler(loop, lambda: asyncio.ensure_future(user_client.disconnect()))
+        worker_links.start_receiver(loop)
+        ingest_logger.info("worker %d 已启动，会话: %s，群组数量: %d", index, session_file, len(chat_ids))
+        loop.run_until_complete(run_with_background(
+            main(),
+            checkpoints.run(),
+            file_id_cache.run(),
+            run_metrics_server(METRICS_PORT + index + 1 if METRICS_PORT else 0)
+        ))
+
+def receive_links(source_chat, entries):
+    save_links([LinkEntry(*entry) for entry in entries], source_chat)
+
+class WorkerSupervisor:
+    """协调进程：启动各 worker 并在退出后重启，接收 worker 解析出的条目统一写入链接存储
+
+    条目写入文件后通过各 worker 的确认队列告知已提交的序号，worker 据此推进检查点。
+    """
+
+    def __init__(self, sessions, chat_ids):
+        # worker 使用 spawn 启动，不继承协调进程中的日志线程和事件循环
+        self.context = multiprocessing.get_context('spawn')
+        self.queue = self.context.Queue()
+        self.sessions = sessions
+        self.shards = shard_chats(chat_ids, len(sessions))
+        self.processes = [None] * len(sessions)
+        self.ack_queues = [None] * len(sessions)
+        self._received = {}  # worker 进程 ID -> 收到的最大序号
+        self._acked = {}  # worker 进程 ID -> 已确认的最大序号
+        self._ack_task = None
+        self.failures = [0] * len(sessions)
+        self.restart_at = [0.0] * len(sessions)
+        self.started_at = [0.0] * len(sessions)
+
+    def start_worker(self, index):
+        previous = self.processes[index]
+        if previous is not None:
+            self._received.pop(previous.pid, None)
+            self._acked.pop(previous.pid, None)
+        ack_queue = self.context.Queue()
+        process = self.context.Process(target=run_worker, name=f"bybot-worker-{index}",
+                                       args=(index, self.sessions[index], self.shards[index], self.queue, ack_queue))
+        process.start()
+        self.processes[index] = process
+        self.ack_queues[index] = ack_queue
+        self.started_at[index] = time.monotonic()
+
+    def start_receiver(self, loop):
+        """在线程中读取 worker 发来的条目，交给事件循环处理"""
+        def receive():
+            while True:
+                try:
+                    pid, seq, source_chat, entries = self.queue.get()
+                except (EOFError, OSError):
+                    return  # 队列已关闭
+                try:
+                    loop.call_soon_threadsafe(self._receive, pid, seq, source_chat, entries)
+                except RuntimeError:
+                    return  # 事件循环已关闭
+
+        threading.Thread(target=receive, name='link-receiver', daemon=True).start()
+
+    def _receive(self, pid, seq, source_chat, entries):
+        receive_links(source_chat, entries)
+        self._received[pid] = max(seq, self._received.get(pid, 0))
+        if self._ack_task is None or self._ack_task.done():
+            self._ack_task = asyncio.ensure_future(self._acknowledge())
+
+    async def _acknowledge(self):
+        """提交链接存储后向各 worker 确认此前收到的序号，提交期间收到的条目在下一轮确认"""
+        try:
+            while self._received != self._acked:
+                await asyncio.sleep(link_store.commit_delay)
+                received = dict(self._received)
+                if not await link_store.flush():
+                    continue
+                ack_queues = {process.pid: queue for process, queue in zip(self.processes, self.ack_queues)
+                              if process is not None}
+                for pid, seq in received.items():
+                    if seq != self._acked.get(pid) and pid in ack_queues:
+                        ack_queues[pid].put((pid, seq))
+                self._acked = received
+        except Exception as e:
+            ingest_logger.error("确认 worker 链接写入时出错: %s", e)
+
+    def stop(self):
+        """通知所有 worker 退出，共同等待最多 FORWARD_DRAIN_TIMEOUT + 5 秒，仍未退出的强制结束"""
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + FORWARD_DRAIN_TIMEOUT + 5
+        for process in self.processes:
+            if process is not None:
+                process.join(max(0, deadline - time.monotonic()))
+                if process.is_alive():
+                    process.kill()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.start_receiver(loop)
+        for index, shard in enumerate(self.shards):
+            if shard:
+                self.start_worker(index)
+            else:
+                ingest_logger.warning("会话 %s 没有分配到来源群组，不启动 worker", self.sessions[index])
+        try:
+            while True:
+                await asyncio.sleep(WORKER_CHECK_SECONDS)
+                now = loop.time()
+                for index, process in enumerate(self.processes):
+                    if process is None or process.is_alive():
+                        continue
+                    if not self.restart_at[index]:
+                        # 连续失败时指数退避，避免会话未登录等问题导致反复重启；运行足够久后重新计数
+                        if time.monotonic() - self.started_at[index] > WORKER_MAX_RESTART_DELAY:
+                            self.failures[index] = 0
+                        self.failures[index] += 1
+                        delay = min(WORKER_MAX_RESTART_DELAY, 2 ** self.failures[index])
+                        self.restart_at[index] = now + delay
+                        ingest_logger.error("worker %d 已退出，退出码 %s，%d 秒后重启",
+                                            index, process.exitcode, delay)
+                    elif now >= self.restart_at[index]:
+                        self.restart_at[index] = 0.0
+                        self.start_worker(index)
+        finally:
+            await loop.run_in_executor(None, self.stop)
+
+def run_supervisor():
+    """多进程模式：各 worker 进程的会话各自接收一部分来源群组，主进程负责链接存储和配置生成"""
+    prepare_link_files()
+    save_initial_md5()
+    supervisor = WorkerSupervisor(WORKER_SESSIONS, SOURCE_CHAT_IDS)
+    logger.info("多进程模式已启动，worker 数量: %d", len(WORKER_SESSIONS))
+
+    async def supervise():
+        # 收到停止信号时取消 supervisor.run()，其 finally 中停止所有 worker
+        task = asyncio.ensure_future(supervisor.run())
+        install_stop_handler(asyncio.get_running_loop(), task.cancel)
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await link_store.flush()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run_with_background(
+        supervise(),
+        link_store.run(),
+        run_evictor(),
+        run_metrics_server(),
+        run_prober(),
+        run_subscription_cache(),
+        monitor_dydzt()
+    ))
+
+if __name__ == "__main__":
+    if WORKER_SESSIONS:
+        run_supervisor()
+    else:
+        run_single()
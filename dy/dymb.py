@@ -1,24 +1,56 @@
-subscriptions = [
-    {'name': '机场_1', 'url': 'http://hs.huasuan666.top/api/v1/client/subscribe?token=a736885ef4bfa933eee31dc50e4bf65c'}
-]
+"""根据订阅地址生成 mihomo 配置文件
 
-yaml_content = """# XX订阅
+既可以作为模块导入调用 render_config / write_config，也可以直接运行：
+    python dymb.py [订阅地址文件] [输出文件]
+"""
+import hashlib
+import json
+import os
+import sys
+from functools import lru_cache
+
+# 默认的订阅地址文件和输出文件路径
+DEFAULT_LINKS_PATH = "/app/dy/dydz.txt"
+DEFAULT_OUTPUT_PATH = "/app/dy/zydy.yaml"
+
+YAML_HEADER = """# XX订阅
 proxy-providers:
 """
 
-for sub in subscriptions:
-    yaml_content += f"""  {sub["name"]}:
-    url: "{sub["url"]}"
+PROVIDER_TEMPLATE = """  {name}:
+    url: {url}
     type: http
-    interval: 86400
+    interval: {interval}
     health-check:
       enable: true
       url: https://www.gstatic.com/generate_204
-      interval: 300
+      interval: {health_interval}{lazy}
     proxy: 直连
 """
 
-yaml_content += """
+# 本地合并的节点文件（由 bot.py 拉取订阅内容后生成）
+FILE_PROVIDER_TEMPLATE = """  {name}:
+    type: file
+    path: {path}
+    interval: 3600
+    health-check:
+      enable: true
+      url: https://www.gstatic.com/generate_204
+      interval: {health_interval}{lazy}
+"""
+
+# 默认的订阅更新间隔和健康检查间隔（秒）
+REFRESH_INTERVAL = 86400
+HEALTH_CHECK_INTERVAL = 300
+
+# 订阅数量达到阈值后使用大规模布局：每个 provider 的更新间隔按订阅地址的哈希错开，
+# 健康检查按组错开间隔并改为 lazy（只在被使用时检查），避免 mihomo 同时发起大量请求
+LARGE_N_THRESHOLD = 50
+REFRESH_JITTER = 3600  # 更新间隔的错开范围
+HEALTH_CHECK_GROUPS = 20  # 健康检查间隔错开的组数
+HEALTH_CHECK_GROUP_STEP = 15  # 相邻两组的健康检查间隔相差的秒数
+
+YAML_STATIC = """
 # 节点信息
 proxies:
   - {name: 直连, type: direct}
@@ -181,6 +213,112 @@ rule-providers:
   netflix_ip: { <<: *ip, url: "https://raw.githubusercontent.com/MetaCubeX/meta-rules-dat/meta/geo/geoip/netflix.mrs" }
 """
 
-# 将生成的 YAML 内容写入文件
-with open("/app/dy/zydy.yaml", "w", encoding="utf-8") as f:
-    f.write(yaml_content)
\ No newline at end of file
+def yaml_quote(value):
+    """JSON 字符串同时也是合法的 YAML 双引号字符串，可安全处理引号等特殊字符"""
+    return json.dumps(value, ensure_ascii=False)
+
+def build_subscriptions(links):
+    """根据订阅地址列表生成 subscriptions 数据"""
+    return [{'name': f'机场_{index + 1}', 'url': link} for index, link in enumerate(links)]
+
+def stable_hash(value):
+    """与进程无关的稳定哈希，保证每次生成的间隔相同"""
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+def provider_schedule(key, large):
+    """返回 provider 的 (更新间隔, 健康检查间隔, 是否 lazy 健康检查)
+
+    大规模布局下，provider 按 key 的哈希分到 HEALTH_CHECK_GROUPS 组之一，
+    每组的健康检查间隔递增 HEALTH_CHECK_GROUP_STEP 秒，组内再按哈希错开，
+    同一时刻发起健康检查的 provider 数量大致不超过一组。
+    间隔只取决于 key，增删其他订阅不会改变已有 provider 的间隔。
+    """
+    if not large:
+        return REFRESH_INTERVAL, HEALTH_CHECK_INTERVAL, False
+    digest = stable_hash(key)
+    interval = REFRESH_INTERVAL + digest % REFRESH_JITTER
+    group = (digest >> 32) % HEALTH_CHECK_GROUPS
+    health_interval = HEALTH_CHECK_INTERVAL + group * HEALTH_CHECK_GROUP_STEP + (digest >> 48) % HEALTH_CHECK_GROUP_STEP
+    return interval, health_interval, True
+
+def lazy_option(lazy):
+    return "\n      lazy: true" if lazy else ""
+
+@lru_cache(maxsize=4096)
+def render_provider(name, url, interval=REFRESH_INTERVAL, health_interval=HEALTH_CHECK_INTERVAL, lazy=False):
+    """渲染单个 proxy-provider 条目"""
+    return PROVIDER_TEMPLATE.format(name=name, url=yaml_quote(url), interval=interval,
+                                    health_interval=health_interval, lazy=lazy_option(lazy))
+
+@lru_cache(maxsize=64)
+def render_file_provider(name, path, health_interval=HEALTH_CHECK_INTERVAL, lazy=False):
+    """渲染引用本地文件的 proxy-provider 条目"""
+    return FILE_PROVIDER_TEMPLATE.format(name=name, path=yaml_quote(path),
+                                         health_interval=health_interval, lazy=lazy_option(lazy))
+
+def render_providers(subscriptions, large=None):
+    """渲染 proxy-providers 部分，只有这部分随订阅地址变化；带 path 的条目引用本地文件
+
+    large 为 None 时，订阅数量达到 LARGE_N_THRESHOLD 后自动使用大规模布局。
+    """
+    if large is None:
+        large = len(subscriptions) >= LARGE_N_THRESHOLD
+    parts = []
+    for sub in subscriptions:
+        if "path" in sub:
+            _, health_interval, lazy = provider_schedule(sub["path"], large)
+            parts.append(render_file_provider(sub["name"], sub["path"], health_interval, lazy))
+        else:
+            interval, health_interval, lazy = provider_schedule(sub["url"], large)
+            parts.append(render_provider(sub["name"], sub["url"], interval, health_interval, lazy))
+    return ''.join(parts)
+
+def render_config(subscriptions):
+    """生成完整的 YAML 配置内容，静态部分直接复用"""
+    return YAML_HEADER + render_providers(subscriptions) + YAML_STATIC
+
+# 已写入文件的内容哈希，避免重复读取输出文件
+_written_digests = {}
+
+def file_digest(path):
+    """计算已有输出文件的内容哈希，文件不存在时返回 None"""
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+def write_config(subscriptions, output_path=DEFAULT_OUTPUT_PATH):
+    """生成 YAML 配置并写入文件，内容未变化时跳过写入
+
+    先写入同目录下的临时文件再原子替换，读取方不会看到写了一半的文件。
+    返回是否实际写入了文件。
+    """
+    data = render_config(subscriptions).encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()
+
+    if output_path not in _written_digests:
+        _written_digests[output_path] = file_digest(output_path)
+    if _written_digests[output_path] == digest:
+        return False
+
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, output_path)
+    _written_digests[output_path] = digest
+    return True
+
+def read_links(links_path):
+    """读取订阅地址文件，每行一个地址"""
+    with open(links_path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+if __name__ == "__main__":
+    links_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_LINKS_PATH
+    output_path = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_OUTPUT_PATH
+
+    # 将生成的 YAML 内容写入文件
+    write_config(build_subscriptions(read_links(links_path)), output_path)
@@ -0,0 +1,81 @@
+"""测试共用的配置和本地 HTTP 服务"""
+import json
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# bot 在导入时读取配置文件，先写入一份只使用临时目录的配置
+WORK_DIR = tempfile.mkdtemp(prefix='bybot-test-')
+CONFIG_PATH = os.path.join(WORK_DIR, 'config.json')
+with open(CONFIG_PATH, 'w', encoding='utf-8') as f:
+    json.dump({
+        'API_ID': 1,
+        'API_HASH': 'test',
+        'SOURCE_CHAT_IDS': [],
+        'TARGET_CHAT_ID': -100,
+        'BOT_TOKEN': '0:test',
+        'SESSION_FILE': os.path.join(WORK_DIR, 'session'),
+        'EXTRACTED_TEXT_FILE': os.path.join(WORK_DIR, 'dydz.txt'),
+        'DYDZ_TXT_PATH': os.path.join(WORK_DIR, 'dydz.txt'),
+        'MD5_FILE_PATH': os.path.join(WORK_DIR, 'dydz.md5'),
+        'DYNB_PY_PATH': os.path.join(ROOT, 'dy', 'dymb.py'),
+        'ZYDY_YAML_PATH': os.path.join(WORK_DIR, 'zydy.yaml'),
+        'METRICS_PORT': 0,
+        'LOG_LEVEL': 'WARNING',
+    }, f)
+os.environ['CONFIG_FILE_PATH'] = CONFIG_PATH
+
+
+class SubscriptionServer:
+    """本地订阅服务：routes 为 路径 -> (状态码, 响应头, 响应体)
+
+    200 响应自动带上 ETag，请求带有相同的 If-None-Match 时返回 304；
+    statuses 按顺序记录每次请求的 (路径, 状态码)。
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.statuses = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, headers, body = server.routes.get(self.path, (404, {}, b''))
+                if status == 200:
+                    etag = '"%x"' % (hash(body) & 0xffffffff)
+                    if self.headers.get('If-None-Match') == etag:
+                        status, body = 304, b''
+                    headers = dict(headers, ETag=etag)
+                server.statuses.append((self.path, status))
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_port}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def url(self, path):
+        return self.base_url + path
+
+
+@pytest.fixture
+def subscription_server():
+    server = SubscriptionServer()
+    server.thread.start()
+    yield server
+    server.httpd.shutdown()
+    server.httpd.server_close()
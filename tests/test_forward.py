@@ -0,0 +1,100 @@
+import asyncio
+import types
+
+import bot
+
+
+class FakeUserClient:
+    """forward_messages 对 unreachable 中的目标抛出 ValueError（用户账号不在群组中）"""
+
+    def __init__(self, unreachable=()):
+        self.unreachable = set(unreachable)
+        self.forwarded = []
+
+    async def forward_messages(self, chat_id, messages, drop_author=None):
+        if chat_id in self.unreachable:
+            raise ValueError(f"Could not find the input entity for {chat_id}")
+        self.forwarded.append((chat_id, [message.id for message in messages]))
+        return messages
+
+    async def download_media(self, message, file=None):
+        file.write(message.content)
+        return file
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_document(self, chat_id, document, **kwargs):
+        self.sent.append((chat_id, [document.filename]))
+        return types.SimpleNamespace(document=None)
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        self.sent.append((chat_id, [item.media.filename for item in media]))
+        return [types.SimpleNamespace(document=None) for _ in media]
+
+
+def media_message(message_id, name, grouped_id=None):
+    return types.SimpleNamespace(id=message_id, chat_id=-1, grouped_id=grouped_id, text='', media=object(),
+                                 file=types.SimpleNamespace(name=name, ext='.pdf', size=3),
+                                 content=name.encode('utf-8'))
+
+
+def test_reference_album_is_forwarded_once_and_falls_back_to_bot(monkeypatch):
+    user_client = FakeUserClient(unreachable={-300})
+    fake_bot = FakeBot()
+    monkeypatch.setattr(bot, 'user_client', user_client)
+    monkeypatch.setattr(bot, 'bot', fake_bot)
+    monkeypatch.setattr(bot, 'MEDIA_FORWARD_BY_REFERENCE', True)
+
+    async def run():
+        queue = bot.ForwardQueue(100, 2, 10 ** 9, 10 ** 9, 1)
+        queue.start()
+        aggregator = bot.DeliveryAggregator(queue, 0.01)
+        monkeypatch.setattr(bot, 'aggregator', aggregator)
+        for message in [media_message(1, 'a.pdf', 9), media_message(2, 'b.pdf', 9), media_message(3, 'c.pdf')]:
+            await bot.forward_media(message, [-200, -300], 'forward')
+        await aggregator.close()
+        await queue.close(timeout=5)
+
+    asyncio.run(run())
+    assert user_client.forwarded == [(-200, [1, 2]), (-200, [3])]
+    assert fake_bot.sent == [(-300, ['a.pdf', 'b.pdf']), (-300, ['c.pdf'])]
+
+
+class UploadingBot:
+    """send_document 为新上传的文件分配 file_id，记录 (文件名, 是否为上传)"""
+
+    def __init__(self):
+        self.sent = []
+        self.names = {}  # file_id -> 上传时的文件名
+
+    async def send_document(self, chat_id, document, **kwargs):
+        if isinstance(document, str):
+            self.sent.append((self.names[document], False))
+            return types.SimpleNamespace(document=None)
+        file_id = f"file-{len(self.names)}"
+        self.names[file_id] = document.filename
+        self.sent.append((document.filename, True))
+        return types.SimpleNamespace(document=types.SimpleNamespace(file_id=file_id))
+
+
+def test_file_id_cache_keeps_file_names_apart(tmp_path, monkeypatch):
+    fake_bot = UploadingBot()
+    monkeypatch.setattr(bot, 'bot', fake_bot)
+    monkeypatch.setattr(bot, 'file_id_cache', bot.FileIdCache(str(tmp_path / 'file_ids.json'), 10))
+
+    async def run():
+        queue = bot.ForwardQueue(100, 2, 10 ** 9, 10 ** 9, 1)
+        queue.start()
+        for name in ['a.pdf', 'b.pdf', 'a.pdf']:
+            buffer = bot.tempfile.SpooledTemporaryFile()
+            buffer.write(b'same content')
+            media = bot.SharedMedia(buffer, 1, name)
+            await queue.put(bot.ForwardJob('document', -200, None, 'sent', (media,), -1))
+        await queue.close(timeout=5)
+
+    asyncio.run(run())
+    # 内容相同但文件名不同时重新上传，文件名相同时使用缓存的 file_id
+    assert fake_bot.sent == [('a.pdf', True), ('b.pdf', True), ('a.pdf', False)]
@@ -0,0 +1,97 @@
+import asyncio
+import os
+import types
+
+import bot
+
+
+def make_store(tmp_path):
+    store = bot.LinkStore(str(tmp_path / 'dydz.txt'), str(tmp_path / 'dydz.meta'))
+    store.load()
+    return store
+
+
+def entry(link):
+    return bot.LinkEntry(100.0, 30.0, link)
+
+
+def read_links(tmp_path):
+    return (tmp_path / 'dydz.txt').read_text(encoding='utf-8').splitlines()
+
+
+def test_remove_keeps_links_appended_by_hand(tmp_path):
+    (tmp_path / 'dydz.txt').write_text('https://a.example.com/sub?token=1\n', encoding='utf-8')
+    store = make_store(tmp_path)
+
+    async def run():
+        store.add([entry('https://b.example.com/sub?token=2')])
+        await store.flush()
+        with open(tmp_path / 'dydz.txt', 'a', encoding='utf-8') as f:
+            f.write('https://manual.example.com/sub?token=3\n')
+        store.add([entry('https://c.example.com/sub?token=4')])
+        await store.flush()
+        await store.remove(['https://a.example.com/sub?token=1'])
+
+    asyncio.run(run())
+    assert read_links(tmp_path) == ['https://b.example.com/sub?token=2', 'https://c.example.com/sub?token=4',
+                                    'https://manual.example.com/sub?token=3']
+    assert 'https://manual.example.com/sub?token=3' in store
+
+
+def test_https_link_replaces_stored_http_link(tmp_path):
+    (tmp_path / 'dydz.txt').write_text('http://a.example.com/sub?token=1\n'
+                                       'https://b.example.com/sub?token=2\n'
+                                       'http://b.example.com/sub?token=2\n'
+                                       'https://c.example.com/sub?token=3\n'
+                                       'http://d.example.com/sub?token=4\n'
+                                       'https://d.example.com/sub?token=4\n', encoding='utf-8')
+    store = make_store(tmp_path)
+    # 加载时同一订阅保留 https 写法
+    assert read_links(tmp_path) == ['http://a.example.com/sub?token=1', 'https://b.example.com/sub?token=2',
+                                    'https://c.example.com/sub?token=3', 'https://d.example.com/sub?token=4']
+
+    async def run():
+        assert store.add([entry('https://a.example.com/sub?token=1'),
+                          entry('http://c.example.com/sub?token=3')]) == []
+        await store.flush()
+
+    asyncio.run(run())
+    assert store.links() == ['https://b.example.com/sub?token=2', 'https://c.example.com/sub?token=3',
+                             'https://d.example.com/sub?token=4', 'https://a.example.com/sub?token=1']
+    assert sorted(read_links(tmp_path)) == sorted(store.links())
+    assert store.metadata('https://a.example.com/sub?token=1')['link'] == 'https://a.example.com/sub?token=1'
+    assert make_store(tmp_path).links() == store.links()
+
+
+def test_flush_creates_missing_link_file(tmp_path):
+    store = make_store(tmp_path)
+
+    async def run():
+        store.add([entry('https://a.example.com/sub?token=1')])
+        await store.flush()
+
+    asyncio.run(run())
+    assert read_links(tmp_path) == ['https://a.example.com/sub?token=1']
+
+
+def test_worker_links_wait_for_coordinator_commit(tmp_path, monkeypatch):
+    store = make_store(tmp_path)
+    monkeypatch.setattr(bot, 'link_store', store)
+    supervisor = bot.WorkerSupervisor(['session'], [-1])
+    # 用当前进程模拟 worker：确认按进程 ID 发送
+    supervisor.processes[0] = types.SimpleNamespace(pid=os.getpid())
+    supervisor.ack_queues[0] = supervisor.context.Queue()
+    links = bot.WorkerLinks(supervisor.queue, supervisor.ack_queues[0])
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        links.start_receiver(loop)
+        links.put(-1, [entry('https://a.example.com/sub?token=1')])
+        # 协调进程尚未接收时不会确认
+        assert await links.flush(0.2) is False
+
+        supervisor.start_receiver(loop)
+        assert await links.flush(5) is True
+        assert read_links(tmp_path) == ['https://a.example.com/sub?token=1']
+
+    asyncio.run(run())
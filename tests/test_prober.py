@@ -0,0 +1,63 @@
+import asyncio
+import socket
+import time
+
+import bot
+
+GB = 1024 ** 3
+
+
+def userinfo(total_gb, used_gb=0, days=30):
+    expire = int(time.time() + days * 86400)
+    return {'subscription-userinfo': f"upload=0; download={int(used_gb * GB)}; total={int(total_gb * GB)}; expire={expire}"}
+
+
+def closed_port_url():
+    # 绑定后立即关闭，得到一个没有服务监听的端口
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}/sub?token=down"
+
+
+def test_probe_all_classifies_links(subscription_server):
+    server = subscription_server
+    server.routes['/ok?token=1'] = (200, userinfo(200, used_gb=50), b'')
+    server.routes['/low?token=2'] = (200, userinfo(60, used_gb=30), b'')
+    server.routes['/expiring?token=3'] = (200, userinfo(200, days=5), b'')
+    server.routes['/gone?token=4'] = (410, {}, b'')
+    server.routes['/plain?token=5'] = (200, {}, b'')
+    server.routes['/error?token=6'] = (502, {}, b'')
+    links = [server.url(path) for path in ['/ok?token=1', '/low?token=2', '/expiring?token=3', '/gone?token=4',
+                                           '/plain?token=5', '/error?token=6', '/unknown?token=7']]
+    links.append(closed_port_url())
+
+    prober = bot.SubscriptionProber(5, 2, 5, 'test')
+    results = asyncio.run(prober.probe_all(links))
+
+    assert [result.link for result in results] == links
+    assert [result.status for result in results] == [
+        'ok', 'failed', 'failed', 'failed', 'unknown', 'unknown', 'failed', 'unknown']
+    assert round(results[0].entry.available_gb) == 150
+    assert results[3].reason == 'HTTP 410'
+
+
+
+def test_prune_links_waits_for_consecutive_failures(tmp_path, subscription_server, monkeypatch):
+    server = subscription_server
+    server.routes['/gone?token=1'] = (410, {}, b'')
+    server.routes['/blocked?token=2'] = (403, {}, b'')
+    server.routes['/low?token=3'] = (200, userinfo(60, used_gb=30), b'')
+    links = [server.url(path) for path in ['/gone?token=1', '/blocked?token=2', '/low?token=3']]
+    store = bot.LinkStore(str(tmp_path / 'dydz.txt'), str(tmp_path / 'dydz.meta'))
+    (tmp_path / 'dydz.txt').write_text(''.join(link + '\n' for link in links), encoding='utf-8')
+    store.load()
+    monkeypatch.setattr(bot, 'link_store', store)
+    monkeypatch.setattr(bot, 'subscription_prober', bot.SubscriptionProber(5, 2, 5, 'test'))
+    monkeypatch.setattr(bot, 'PROBE_FAILURES_BEFORE_DELETE', 2)
+
+    # 剩余流量不足的链接立即删除，返回失效状态码的链接第二次失败时才删除，403 不计为失败
+    assert asyncio.run(bot.prune_links()) == [links[2]]
+    assert store.metadata(links[0])['probe_failures'] == 1
+    assert asyncio.run(bot.prune_links()) == [links[0]]
+    assert store.links() == [links[1]]
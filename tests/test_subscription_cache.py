@@ -0,0 +1,88 @@
+import asyncio
+import base64
+import json
+
+import bot
+
+
+def vmess(name, address):
+    config = {'v': '2', 'ps': name, 'add': address, 'port': '443', 'id': 'uuid'}
+    return 'vmess://' + base64.b64encode(json.dumps(config).encode('utf-8')).decode('ascii')
+
+
+def make_cache(tmp_path):
+    return bot.SubscriptionCache(str(tmp_path / 'cache'), str(tmp_path / 'merged.txt'), 5, 2, 5, 'test')
+
+
+def read_nodes(tmp_path):
+    return (tmp_path / 'merged.txt').read_text(encoding='utf-8').splitlines()
+
+
+def setup_routes(server):
+    # 两个机场有一个完全相同的节点和一个同名但不同的节点，第三个订阅不是节点列表
+    server.routes['/a?token=1'] = (200, {}, base64.b64encode('\n'.join([
+        'trojan://pw@h1.example.com:443#HK 01',
+        'ss://YWVzOnB3@h2.example.com:8388#JP 01',
+    ]).encode('utf-8')))
+    server.routes['/b?token=2'] = (200, {}, '\n'.join([
+        'trojan://pw@h1.example.com:443#香港 A',
+        vmess('JP 01', 'h3.example.com'),
+    ]).encode('utf-8'))
+    server.routes['/c?token=3'] = (200, {}, b'proxies:\n  - {name: x, type: ss}\n')
+    return [server.url(path) for path in ['/a?token=1', '/b?token=2', '/c?token=3', '/missing?token=4']]
+
+
+def test_refresh_merges_and_deduplicates_nodes(tmp_path, subscription_server):
+    links = setup_routes(subscription_server)
+    cache = make_cache(tmp_path)
+    cache.load()
+
+    assert asyncio.run(cache.refresh(links)) is True
+    assert sorted(status for _, status in subscription_server.statuses) == [200, 200, 200, 404]
+
+    nodes = read_nodes(tmp_path)
+    assert len(nodes) == 3
+    assert nodes[:2] == ['trojan://pw@h1.example.com:443#HK 01', 'ss://YWVzOnB3@h2.example.com:8388#JP 01']
+    # 同名节点加上机场名区分
+    assert bot.node_name(nodes[2]) == 'JP 01 (机场_2)'
+    assert cache.merged_links == frozenset(links[:2])
+
+
+def test_refresh_uses_conditional_requests(tmp_path, subscription_server):
+    links = setup_routes(subscription_server)
+    cache = make_cache(tmp_path)
+    cache.load()
+    asyncio.run(cache.refresh(links))
+    nodes = read_nodes(tmp_path)
+    subscription_server.statuses.clear()
+
+    assert asyncio.run(cache.refresh(links)) is False
+    assert sorted(status for _, status in subscription_server.statuses) == [304, 304, 304, 404]
+    assert read_nodes(tmp_path) == nodes
+
+
+def test_load_restores_merged_state(tmp_path, subscription_server):
+    links = setup_routes(subscription_server)
+    cache = make_cache(tmp_path)
+    cache.load()
+    asyncio.run(cache.refresh(links))
+
+    restarted = make_cache(tmp_path)
+    restarted.load()
+    assert restarted.merged_links == cache.merged_links
+    assert restarted.merged_shards == cache.merged_shards
+    # 重启后内容未变化时不需要重新生成配置文件
+    assert asyncio.run(restarted.refresh(links)) is False
+
+
+def test_failed_fetch_keeps_cached_body(tmp_path, subscription_server):
+    links = setup_routes(subscription_server)
+    cache = make_cache(tmp_path)
+    cache.load()
+    asyncio.run(cache.refresh(links))
+    nodes = read_nodes(tmp_path)
+
+    subscription_server.routes['/a?token=1'] = (500, {}, b'')
+    assert asyncio.run(cache.refresh(links)) is False
+    assert read_nodes(tmp_path) == nodes
+    assert links[0] in cache.merged_links